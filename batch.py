@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+# sessions run headless, the dummy driver keeps pygame from looking for a display
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+from pygame import Rect
+import main
+
+
+# a session is a dict:
+#   name    label copied into the result
+#   level   level file to stream, the built in level when missing
+#   ticks   how many ticks to simulate
+#   seed    seed of the random module
+#   inputs  [tick, "up" | "left" | "right", pressed] in any order
+#   goals   [x, y, width, height] areas the player should reach
+
+
+def run_session(session):
+    # the engine lives in module level singletons, reset so sessions don't see each other
+    main.reset()
+    random.seed(session.get("seed", 0))
+    if session.get("level"):
+        main.world.stream(session["level"])
+    else:
+        main.build_level(main.world)
+    engine = main.Engine(headless=True)
+    player = engine.player
+    keys = {"up": player.key_config.key_up, "left": player.key_config.key_left,
+            "right": player.key_config.key_right}
+    inputs = sorted((tick, keys[key], pressed) for tick, key, pressed in session.get("inputs", ()))
+    goals = [Rect(goal) for goal in session.get("goals", ())]
+    reached = [None] * len(goals)
+    ticks = session["ticks"]
+    next_input = 0
+    start = time.perf_counter()
+    for tick in range(ticks):
+        while next_input < len(inputs) and inputs[next_input][0] <= tick:
+            main.EventManager.add_key(inputs[next_input][2], inputs[next_input][1])
+            next_input += 1
+        engine.step()
+        for index, goal in enumerate(goals):
+            if reached[index] is None and goal.colliderect(player.rect):
+                reached[index] = tick
+    elapsed = time.perf_counter() - start
+    return {
+        "name": session.get("name"),
+        "ticks": ticks,
+        "final": {"rect": list(player.rect), "state": player.state.name, "on_ground": player.on_ground},
+        # tick each goal was first reached on, None when it never was
+        "reached": reached,
+        "seconds": elapsed,
+        "ticks_per_sec": ticks / elapsed if elapsed else None,
+    }
+
+
+def run_batch(sessions, workers=None):
+    # results in the order of sessions; spawned processes start from a clean import of main
+    # and every worker runs many sessions
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(workers or os.cpu_count()) as pool:
+        results = pool.map(run_session, sessions, chunksize=1)
+        # let the workers run out of work and exit, SDL catches the SIGTERM of terminate
+        pool.close()
+        pool.join()
+    return results
+
+
+def main_batch():
+    parser = argparse.ArgumentParser(description="Run scripted headless sessions in parallel")
+    parser.add_argument("sessions", help="JSON file with a list of sessions")
+    parser.add_argument("--workers", type=int, help="worker processes, the number of cores by default")
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    with open(args.sessions) as file:
+        sessions = json.load(file)
+    start = time.perf_counter()
+    results = run_batch(sessions, args.workers)
+    report = json.dumps({"sessions": results, "seconds": time.perf_counter() - start}, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(report + "\n")
+    else:
+        print(report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_batch())
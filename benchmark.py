@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+# rendering is timed too, so a window is needed; the dummy driver keeps runs reproducible
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import pygame
+import main
+from game import game
+
+
+PHASES = ("events", "physics", "camera", "render", "display")
+
+
+def generate_level(world, rng, solid, moving, entities, gui, level_width, level_height):
+    main.camera.set_level_area(level_width, level_height)
+    # borders
+    world.add_block(main.SolidBlock(0, 0, level_width, 20))
+    world.add_block(main.SolidBlock(0, 0, 20, level_height))
+    world.add_block(main.SolidBlock(0, level_height - 20, level_width, 20))
+    world.add_block(main.SolidBlock(level_width - 20, 0, 20, level_height))
+    for _ in range(solid):
+        width, height = rng.randint(20, 400), rng.randint(20, 40)
+        world.add_block(main.SolidBlock(rng.randint(20, level_width - width - 20),
+                                        rng.randint(20, level_height - height - 20), width, height))
+    for _ in range(moving):
+        width, distance = rng.randint(50, 200), rng.randint(50, 400)
+        world.add_block(main.MovingBlock(rng.randint(distance + 20, max(distance + 20, level_width - width - distance - 20)),
+                                         rng.randint(40, level_height - 60), width, 40, distance, rng.randint(1, 3)))
+    for _ in range(entities):
+        world.add_entity(main.Player(rng.randint(40, level_width - 80), rng.randint(40, level_height - 80), 40, 40))
+    for index in range(gui):
+        x, y = rng.randint(0, game.window_width - 120), rng.randint(0, game.window_height - 60)
+        kind = index % 3
+        if kind == 0:
+            world.add_gui(main.HealthBar(x, y, 100, 30))
+        elif kind == 1:
+            world.add_gui(main.Label(x, y, 100, 30, "Label %d" % index, (40, 40, 40), (255, 255, 255), "verdana", 16))
+        else:
+            world.add_gui(main.Button(x, y, 100, 50, 20, "Button %d" % index, (255, 0, 0, 0), (0, 255, 0, 0), "verdana", 16))
+
+
+def summary(samples):
+    mean, p50, p99, worst = main.summarize(samples)
+    return {"mean_ms": mean, "p50_ms": p50, "p99_ms": p99}
+
+
+def run_benchmark(engine, rng, ticks, warmup):
+    keys = (engine.player.key_config.key_up, engine.player.key_config.key_left, engine.player.key_config.key_right)
+    samples = {phase: [] for phase in PHASES}
+    frames = []
+    black = pygame.Color("black")
+    clock = time.perf_counter
+    start = None
+    for tick in range(warmup + ticks):
+        if tick == warmup:
+            start = clock()
+        # scripted input, the same for every run with the same seed
+        if rng.random() < 0.08:
+            main.EventManager.add_key(rng.random() < 0.5, rng.choice(keys))
+        t0 = clock()
+        main.EventManager.process_normal()
+        engine.handle_input()
+        main.EventManager.process()
+        t1 = clock()
+        engine.world.physic()
+        t2 = clock()
+        engine.camera.update(engine.player)
+        t3 = clock()
+        game.screen.fill(black)
+        engine.world.render()
+        t4 = clock()
+        pygame.display.update()
+        t5 = clock()
+        if tick >= warmup:
+            for phase, duration in zip(PHASES, (t1 - t0, t2 - t1, t3 - t2, t4 - t3, t5 - t4)):
+                samples[phase].append(duration)
+            frames.append(t5 - t0)
+    elapsed = clock() - start
+    return {
+        "ticks": ticks,
+        "ticks_per_sec": ticks / elapsed,
+        "frame": summary(frames),
+        "phases": {phase: summary(samples[phase]) for phase in PHASES},
+    }
+
+
+def compare(result, baseline, tolerance, min_delta_ms):
+    # a metric regresses when it is more than tolerance worse than the baseline,
+    # timings below min_delta_ms apart are treated as noise
+    regressions = []
+    if result["ticks_per_sec"] < baseline["ticks_per_sec"] * (1 - tolerance):
+        regressions.append(("ticks_per_sec", baseline["ticks_per_sec"], result["ticks_per_sec"]))
+    timings = [("frame", result["frame"], baseline["frame"])]
+    timings.extend((phase, result["phases"][phase], baseline["phases"][phase]) for phase in PHASES)
+    for name, current, previous in timings:
+        for metric in ("p50_ms", "p99_ms"):
+            if (current[metric] > previous[metric] * (1 + tolerance) and
+                    current[metric] - previous[metric] > min_delta_ms):
+                regressions.append(("%s.%s" % (name, metric), previous[metric], current[metric]))
+    return regressions
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description="Engine performance benchmark on a generated level")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--solid", type=int, default=200, help="number of SolidBlocks")
+    parser.add_argument("--moving", type=int, default=20, help="number of MovingBlocks")
+    parser.add_argument("--entities", type=int, default=10, help="number of extra entities")
+    parser.add_argument("--gui", type=int, default=10, help="number of GUI widgets")
+    parser.add_argument("--particles", type=int, default=0, help="live particles, kept up by a fountain")
+    parser.add_argument("--level-width", type=int, default=8000)
+    parser.add_argument("--level-height", type=int, default=4000)
+    parser.add_argument("--ticks", type=int, default=1000)
+    parser.add_argument("--warmup", type=int, default=100)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", help="JSON report to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="allowed relative slowdown")
+    parser.add_argument("--min-delta-ms", type=float, default=0.05, help="ignore smaller timing differences")
+    args = parser.parse_args()
+
+    config = {name: getattr(args, name) for name in
+              ("seed", "solid", "moving", "entities", "gui", "particles", "level_width", "level_height", "ticks",
+               "warmup")}
+    rng = random.Random(args.seed)
+    generate_level(main.world, rng, args.solid, args.moving, args.entities, args.gui,
+                   args.level_width, args.level_height)
+    engine = main.Engine()
+    if args.particles:
+        # each particle lives 60 ticks on average, so the fountain keeps about the asked number alive
+        particles = main.ParticleSystem(capacity=2*args.particles, seed=args.seed)
+        main.world.add_particles(particles)
+        main.Emitter(particles, engine.player, args.particles / 60, life=(30, 90), color=(255, 200, 80),
+                     color_jitter=40)
+    result = run_benchmark(engine, rng, args.ticks, args.warmup)
+    result["config"] = config
+    # pixels held by the shared block and entity sheets
+    result["surface_bytes"] = main.assets.memory()
+
+    report = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(report + "\n")
+    else:
+        print(report)
+
+    if args.baseline:
+        if args.save_baseline or not os.path.exists(args.baseline):
+            with open(args.baseline, "w") as file:
+                file.write(report + "\n")
+            return 0
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if baseline.get("config") != config:
+            print("baseline was recorded with a different configuration", file=sys.stderr)
+            return 2
+        regressions = compare(result, baseline, args.tolerance, args.min_delta_ms)
+        for name, previous, current in regressions:
+            print("regression %s: %.3f -> %.3f" % (name, previous, current), file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_benchmark())
@@ -17,10 +17,23 @@ class Game:
         self.window_width = window_width
         self.window_height = window_height
         self.fps = fps
-        self.screen = pygame.display.set_mode((self.window_width,
-                                               self.window_height))
-        pygame.display.set_caption(title)
+        self.title = title
+        self.screen = None
         # user defined values
 
+    def open_window(self):
+        """
+        Creates the window, headless runs never call this.
+        """
+        if self.screen is None:
+            self.screen = pygame.display.set_mode((self.window_width,
+                                                   self.window_height))
+            pygame.display.set_caption(self.title)
+        return self.screen
+
+    @property
+    def headless(self):
+        return self.screen is None
+
 
 game = Game(1000, 600, 60)
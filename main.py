@@ -1,39 +1,201 @@
 #!/usr/bin/env python3
 
-import copy
+import argparse
+from array import array
+import bisect
+from collections import OrderedDict
 import enum
+import json
 import math
+import mmap
+try:
+    import numpy
+except ImportError:
+    numpy = None
 import pygame
 from pygame.locals import *
+import queue
 import random
+import struct
 import sys
+import threading
+import time
 from game import game
 from pprint import pprint
 
 
 class Log:
 
-    def __init__(self, *args):
+    def __init__(self, capacity=18000, keyframe_interval=60):
         self.objects = []
-        self.temp = None
-        self.data = []
+        # ring buffer of packed frames, frame n lives in slot n % capacity;
+        # every keyframe_interval-th frame is a full keyframe, the rest are deltas;
+        # the default keeps five minutes at 60 ticks per second
+        self.capacity = capacity
+        self.keyframe_interval = keyframe_interval
+        self.frames = [None] * capacity
+        self.sizes = []
+        self.start = 0
+        self.count = 0
+        self.last = None
 
     def add_object(self, obj):
         self.objects.append(obj)
+        # the packed layout changed, recorded frames can't be decoded any more
+        self.clear()
+
+    def clear(self):
+        self.frames = [None] * self.capacity
+        self.sizes = []
+        self.start = 0
+        self.count = 0
+        self.last = None
+
+    def record(self):
+        values = array("d")
+        sizes = []
+        for obj in self.objects:
+            state = obj.record_state()
+            values.extend(state)
+            sizes.append(len(state))
+        if self.count % self.keyframe_interval == 0:
+            self.sizes = sizes
+            frame = values.tobytes()
+        else:
+            changed = array("I", [index for index, (old, new) in enumerate(zip(self.last, values)) if old != new])
+            frame = changed.tobytes() + array("d", [values[index] for index in changed]).tobytes()
+        self.frames[self.count % self.capacity] = frame
+        self.last = values
+        self.count += 1
+        self.start = max(self.start, self.count - self.capacity)
+
+    def oldest(self):
+        # the oldest frame which still has its keyframe in the buffer
+        return self.start + (-self.start) % self.keyframe_interval
+
+    def frame_values(self, frame):
+        if not self.oldest() <= frame < self.count:
+            raise IndexError("frame %d is not in the log" % frame)
+        keyframe = frame - frame % self.keyframe_interval
+        values = array("d")
+        values.frombytes(self.frames[keyframe % self.capacity])
+        for delta in range(keyframe + 1, frame + 1):
+            packed = self.frames[delta % self.capacity]
+            changed = array("I")
+            changed.frombytes(packed[:len(packed)//3])
+            new_values = array("d")
+            new_values.frombytes(packed[len(packed)//3:])
+            for index, value in zip(changed, new_values):
+                values[index] = value
+        return values
+
+    def seek(self, frame):
+        # restores the objects to the given frame, recording continues from there
+        values = self.frame_values(frame)
+        offset = 0
+        for obj, size in zip(self.objects, self.sizes):
+            obj.restore_state(values[offset:offset + size])
+            offset += size
+        self.count = frame + 1
+        self.last = values
+
+    def rewind(self, frames=1):
+        self.seek(max(self.oldest(), self.count - 1 - frames))
+
+
+log = Log()
 
-    def possible_record(self):
-        self.temp = [copy.deepcopy(obj.__dict__) for obj in self.objects]
 
-    def accept_record(self):
-        self.data.append(self.temp)
-        self.data.append([obj.__dict__ for obj in self.objects])
-        self.temp = None
+def summarize(samples):
+    # mean, median, 99th percentile and maximum of timings in seconds, in milliseconds
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0, 0.0, 0.0, 0.0
+    return (1000*sum(ordered)/len(ordered), 1000*ordered[len(ordered)//2],
+            1000*ordered[min(len(ordered) - 1, int(0.99*len(ordered)))], 1000*ordered[-1])
+
+
+class Profiler:
+
+    # per frame timings of named phases, kept for the last window frames;
+    # listeners and layers add the timings of every event callback and render layer
+    buckets = (1, 2, 4, 8, 16, 33, 66)
+    layer_names = tuple("render layer %d" % layer for layer in range(5))
+
+    def __init__(self, window=300, listeners=False, layers=False, output=None):
+        self.window = window
+        self.listeners = listeners
+        self.layers = layers
+        self.samples = dict()
+        self.current = dict()
+        self.frame = 0
+        self.started = self.last = 0.0
+        self.file = None
+        if output is not None:
+            self.open(output)
+
+    def open(self, path):
+        # .csv gets frame,name,ms rows, anything else one JSON object per frame
+        self.file = open(path, "w")
+        self.csv = path.endswith(".csv")
+        if self.csv:
+            self.file.write("frame,name,ms\n")
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def begin(self):
+        self.current = dict()
+        self.started = self.last = time.perf_counter()
+
+    def lap(self, name):
+        # time since the previous lap or begin()
+        now = time.perf_counter()
+        self.add(name, now - self.last)
+        self.last = now
+
+    def add(self, name, seconds):
+        self.current[name] = self.current.get(name, 0.0) + seconds
+
+    def end(self):
+        current = self.current
+        # listener and layer timings are part of the phases, the frame is timed as a whole
+        current["frame"] = time.perf_counter() - self.started
+        slot = self.frame % self.window
+        for name in current.keys() - self.samples.keys():
+            self.samples[name] = array("d", bytes(8*self.window))
+        for name, samples in self.samples.items():
+            samples[slot] = current.get(name, 0.0)
+        if self.file is not None:
+            self.write(current)
+        self.frame += 1
+
+    def write(self, current):
+        if self.csv:
+            self.file.write("".join("%d,%s,%.4f\n" % (self.frame, name, 1000*seconds)
+                                    for name, seconds in current.items()))
+        else:
+            self.file.write(json.dumps({"frame": self.frame,
+                                        "ms": {name: round(1000*seconds, 4) for name, seconds in current.items()}}) + "\n")
 
-    def add_record(self):
-        self.data.append([obj.__dict__ for obj in self.objects])
+    def recent(self, name):
+        return self.samples[name][:min(self.frame, self.window)]
 
+    def stats(self, name):
+        # mean, median, 99th percentile and maximum over the window, in milliseconds
+        return summarize(self.recent(name))
 
-log = Log()
+    def histogram(self, name):
+        # frames per bucket: below 1 ms, below 2 ms, ..., the last one for everything slower
+        counts = [0] * (len(self.buckets) + 1)
+        for seconds in self.recent(name):
+            counts[bisect.bisect_right(self.buckets, 1000*seconds)] += 1
+        return counts
+
+    def names(self):
+        return sorted(self.samples, key=lambda name: (name == "frame", name))
 
 
 class GameCamera:
@@ -50,15 +212,16 @@ class GameCamera:
     def apply(self, target):
         return target.x - self.state.x, target.y - self.state.y, target.width, target.height
 
-    def update(self, target):
-        self.state.center = target.rect.center
-        if target.rect.x < (self.state.width - target.rect.width)/2:
+    def update(self, target, alpha=1.0):
+        rect = target.interpolated_rect(alpha)
+        self.state.center = rect.center
+        if rect.x < (self.state.width - rect.width)/2:
             self.state.x = 0
-        elif target.rect.x > self.level_width - (self.state.width + target.rect.width)/2:
+        elif rect.x > self.level_width - (self.state.width + rect.width)/2:
             self.state.x = self.level_width - self.state.width
-        if target.rect.y < (self.state.height - target.rect.height)/2:
+        if rect.y < (self.state.height - rect.height)/2:
             self.state.y = 0
-        elif target.rect.y > self.level_height - (self.state.height + target.rect.height)/2:
+        elif rect.y > self.level_height - (self.state.height + rect.height)/2:
             self.state.y = self.level_height - self.state.height
 
 
@@ -66,6 +229,154 @@ camera = GameCamera(game.window_width, game.window_height)
 camera.set_level_area(2000, 1000)
 
 
+class Sheet:
+
+    # a surface shared by many images; convert() swaps the surface, images only hold the sheet
+    __slots__ = ("surface", "alpha")
+
+    def __init__(self, surface, alpha=False):
+        self.surface = surface
+        self.alpha = alpha
+
+
+class AtlasImage:
+
+    # the area of a sheet one object is drawn from
+    __slots__ = ("sheet", "area")
+
+    def __init__(self, sheet, area):
+        self.sheet = sheet
+        self.area = area
+
+    def get_size(self):
+        return self.area.size
+
+    def blit_args(self, position):
+        return self.sheet.surface, position, self.area
+
+
+def image_blit(image, position):
+    # (source, dest, area) for Surface.blit and Surface.blits, for surfaces and atlas images alike
+    if isinstance(image, AtlasImage):
+        return image.blit_args(position)
+    return image, position, None
+
+
+class AtlasPage:
+
+    def __init__(self, size):
+        self.sheet = Sheet(pygame.Surface((size, size), SRCALPHA), alpha=True)
+        self.size = size
+        # shelves of [top, height, used width], filled left to right
+        self.shelves = []
+        self.bottom = 0
+
+    def insert(self, width, height):
+        for shelf in self.shelves:
+            if height <= shelf[1] <= 2*height and shelf[2] + width <= self.size:
+                area = Rect(shelf[2], shelf[0], width, height)
+                shelf[2] += width
+                return area
+        if self.bottom + height > self.size or width > self.size:
+            return None
+        self.shelves.append([self.bottom, height, width])
+        self.bottom += height
+        return Rect(0, self.bottom - height, width, height)
+
+
+class Assets:
+
+    def __init__(self, swatch_limit=512, sprite_limit=128, page_size=1024):
+        # solid colors up to swatch_limit share one swatch per color, larger ones one sheet per size;
+        # images up to sprite_limit are packed into atlas pages of page_size
+        self.swatch_limit = swatch_limit
+        self.sprite_limit = sprite_limit
+        self.page_size = page_size
+        self.swatches = dict()
+        self.solids = dict()
+        self.images = dict()
+        self.pages = []
+        self.sheets = []
+
+    def add_sheet(self, surface, alpha=False):
+        sheet = Sheet(surface, alpha)
+        self.convert_sheet(sheet)
+        self.sheets.append(sheet)
+        return sheet
+
+    def convert_sheet(self, sheet):
+        # surfaces in the display format take the fast blit path, which needs the window
+        if not game.headless:
+            sheet.surface = sheet.surface.convert_alpha() if sheet.alpha else sheet.surface.convert()
+
+    def convert(self):
+        # called once the window is open, for the sheets made before
+        for sheet in self.sheets:
+            self.convert_sheet(sheet)
+
+    def solid(self, size, color):
+        color = tuple(pygame.Color(color))
+        width, height = size
+        if width > self.swatch_limit or height > self.swatch_limit:
+            image = self.solids.get((size, color))
+            if image is None:
+                surface = pygame.Surface(size)
+                surface.fill(color)
+                image = AtlasImage(self.add_sheet(surface), Rect((0, 0), size))
+                self.solids[(size, color)] = image
+            return image
+        sheet = self.swatches.get(color)
+        if sheet is None:
+            surface = pygame.Surface(size)
+            surface.fill(color)
+            sheet = self.swatches[color] = self.add_sheet(surface)
+        elif width > sheet.surface.get_width() or height > sheet.surface.get_height():
+            # the swatch grows, the areas handed out so far stay valid
+            surface = pygame.Surface((max(width, sheet.surface.get_width()), max(height, sheet.surface.get_height())))
+            surface.fill(color)
+            sheet.surface = surface
+            self.convert_sheet(sheet)
+        return AtlasImage(sheet, Rect((0, 0), size))
+
+    def image(self, path, size=None):
+        image = self.images.get((size, path))
+        if image is not None:
+            return image
+        surface = pygame.image.load(path)
+        if size is not None:
+            surface = pygame.transform.smoothscale(surface, size)
+        width, height = surface.get_size()
+        if width > self.sprite_limit or height > self.sprite_limit:
+            image = AtlasImage(self.add_sheet(surface, alpha=True), surface.get_rect())
+        else:
+            image = self.pack(surface)
+        self.images[(size, path)] = image
+        return image
+
+    def pack(self, surface):
+        width, height = surface.get_size()
+        for page in self.pages:
+            area = page.insert(width, height)
+            if area is not None:
+                break
+        else:
+            page = AtlasPage(self.page_size)
+            self.convert_sheet(page.sheet)
+            self.pages.append(page)
+            self.sheets.append(page.sheet)
+            area = page.insert(width, height)
+        # the area is still transparent black, max copies the pixels as they are
+        page.sheet.surface.blit(surface, area, special_flags=BLEND_RGBA_MAX)
+        return AtlasImage(page.sheet, area)
+
+    def memory(self):
+        # bytes held by all sheets
+        return sum(sheet.surface.get_pitch()*sheet.surface.get_height() for sheet in self.sheets)
+
+
+assets = Assets()
+
+
 class GameObject(pygame.sprite.Sprite):
 
     def __init__(self, x, y, width, height):
@@ -75,23 +386,64 @@ class GameObject(pygame.sprite.Sprite):
         self.layer = 0
         self.solid = True
         self.visible = True
+        # position before the last simulation step, used for render interpolation
+        self.previous_rect = None
+        # set when the object looks different without having moved
+        self.dirty = False
 
-    def render(self):
-        if camera.state.colliderect(self.rect):
-            game.screen.blit(self.image, camera.apply(self.rect))
+    def interpolated_rect(self, alpha):
+        if self.previous_rect is None or alpha >= 1:
+            return self.rect
+        return Rect(round(self.previous_rect.x + (self.rect.x - self.previous_rect.x)*alpha),
+                    round(self.previous_rect.y + (self.rect.y - self.previous_rect.y)*alpha),
+                    self.rect.width, self.rect.height)
 
-    def notify(self, event):
-        pass
+    def record_state(self):
+        return self.rect.x, self.rect.y, self.rect.width, self.rect.height
+
+    def restore_state(self, values):
+        self.rect.x, self.rect.y, self.rect.width, self.rect.height = (int(value) for value in values[:4])
+
+    def invalidate(self):
+        self.dirty = True
+
+    def image_rect(self, alpha=1.0):
+        # the level area the image covers, it may be larger than rect
+        return Rect(self.interpolated_rect(alpha).topleft, self.image.get_size())
+
+    def screen_rect(self, alpha=1.0):
+        # area of the screen render() draws to, None when it draws nothing
+        rect = self.image_rect(alpha)
+        if camera.state.colliderect(rect):
+            return Rect(camera.apply(rect))
+        return None
+
+    def render(self, alpha=1.0, surface=None):
+        # surface defaults to the screen
+        rect = self.image_rect(alpha)
+        if camera.state.colliderect(rect):
+            (surface or game.screen).blit(*image_blit(self.image, camera.apply(rect)[:2]))
 
 
 class SolidBlock(GameObject):
 
     def __init__(self, x, y, width, height):
         super().__init__(x, y, width, height)
-        self.image = pygame.Surface((width+5, height+5))
-        self.image.fill(pygame.Color("gray"))
+        self.image = assets.solid((width+5, height+5), "gray")
         self.moving = False
 
+    @property
+    def visible(self):
+        return self._visible
+
+    @visible.setter
+    def visible(self, visible):
+        changed = visible != getattr(self, "_visible", visible)
+        self._visible = visible
+        if changed:
+            # baked chunks have to be redrawn without or with the block
+            world.refresh_block(self)
+
 
 class MovingBlock(SolidBlock):
 
@@ -108,28 +460,17 @@ class MovingBlock(SolidBlock):
         self.distance = distance
         self.speed = speed
         self.moving = True
-        TickEvent.register(self)
-
-    def notify(self, event):
-        if event.name == "tick":
-            if self.direction == self.DirectionState.left:
-                if self.rect.x < self.initial_x - self.distance:
-                    self.direction = self.DirectionState.right
-                    self.move_right()
-                else:
-                    self.move_left()
-            elif self.direction == self.DirectionState.right:
-                if self.rect.x > self.initial_x + self.distance:
-                    self.direction = self.DirectionState.left
-                    self.move_left()
-                else:
-                    self.move_right()
+        # displacement of the current tick, riders are carried by it
+        self.velocity = pygame.math.Vector2(self.direction.value*speed, 0)
 
-    def move_left(self):
-        self.rect.x -= self.speed
+    def record_state(self):
+        return super().record_state() + (self.direction.value,)
 
-    def move_right(self):
-        self.rect.x += self.speed
+    def restore_state(self, values):
+        super().restore_state(values)
+        self.direction = self.DirectionState(int(values[4]))
+        self.velocity.x = self.direction.value*self.speed
+        world.move_block(self)
 
 
 class EntityState(enum.Enum):
@@ -145,21 +486,95 @@ class EntityState(enum.Enum):
         falling_right = 9
 
 
+class StateMachine:
+
+    def __init__(self, states, inputs):
+        # inputs name the bits of the input mask, the first one is bit 0
+        self.states = list(states)
+        self.index = {state: index for index, state in enumerate(self.states)}
+        self.bits = {name: 1 << index for index, name in enumerate(inputs)}
+        self.size = 1 << len(self.bits)
+        self.rules = {state: [] for state in self.states}
+        self.forces = dict()
+        self.transitions = None
+        self.force_functions = None
+
+    def mask(self, names):
+        mask = 0
+        for name in names:
+            mask |= self.bits[name]
+        return mask
+
+    def transition(self, state, to, when=(), unless=(), action=None):
+        # rules of one state are tried in the order they were added, the first match wins;
+        # a rule matches when all inputs in when are set and none in unless
+        self.rules[state].append((self.mask(when), self.mask(unless), to, action))
+
+    def force(self, state, function):
+        self.forces[state] = function
+
+    def compile(self):
+        # one (next state, action) entry for every state and input mask
+        self.transitions = []
+        for state in self.states:
+            for mask in range(self.size):
+                entry = (state, None)
+                for required, forbidden, to, action in self.rules[state]:
+                    if mask & required == required and not mask & forbidden:
+                        entry = (to, action)
+                        break
+                self.transitions.append(entry)
+        self.force_functions = {state: self.forces.get(state) for state in self.states}
+        return self
+
+    def step(self, entity, mask):
+        state, action = self.transitions[self.index[entity.state]*self.size + mask]
+        entity.state = state
+        if action is not None:
+            action(entity)
+
+    def apply_force(self, entity):
+        function = self.force_functions[entity.state]
+        if function is not None:
+            function(entity)
+
+
 class Entity(GameObject):
 
+    # StateMachine driving state and forces, set by subclasses
+    machine = None
+
     def __init__(self, x, y, width, height):
         super().__init__(x, y, width, height)
-        self.image = pygame.Surface((width+10, height+10))
-        self.image.fill(pygame.Color("blue"))
+        self.image = assets.solid((width+10, height+10), "blue")
         self.layer = 2
         self.force = pygame.math.Vector2(0, 0)
         self.state = EntityState.standing
+        # sleeping entities are skipped by the physics step until something wakes them
+        self.asleep = False
+
+    def record_state(self):
+        return super().record_state() + (self.force.x, self.force.y, self.state.value)
+
+    def restore_state(self, values):
+        super().restore_state(values)
+        self.force.x, self.force.y = values[4], values[5]
+        self.state = EntityState(int(values[6]))
+        world.move_entity(self)
+        self.wake()
+
+    def wake(self):
+        self.asleep = False
+        world.sleeping.discard(self)
+
+    def set_force(self):
+        self.machine.apply_force(self)
 
     def move_x(self):
-        self.rect.x += self.force.x
+        self.rect.x += world.sweep(self.rect, self.force.x, 0)[0]
 
     def move_y(self):
-        self.rect.y += self.force.y
+        self.rect.y += world.sweep(self.rect, 0, self.force.y)[1]
 
     def collide_x(self, block):
         if self.force.x < 0:
@@ -174,17 +589,19 @@ class Entity(GameObject):
             self.rect.bottom = block.rect.top
 
     def physic(self):
+        if self.machine is None:
+            # without a StateMachine an entity isn't simulated, only drawn
+            return
         self.set_force()
+        before = swept = self.rect.copy()
         self.move_x()
-        for layer in range(5):
-            for block in world.blocks[layer]:
-                if self.rect.colliderect(block):
-                    self.collide_x(block)
+        for block in world.colliding_blocks(self.rect, swept.union(self.rect)):
+            self.collide_x(block)
+        swept = self.rect.copy()
         self.move_y()
-        for layer in range(5):
-            for block in world.blocks[layer]:
-                if self.rect.colliderect(block):
-                    self.collide_y(block)
+        for block in world.colliding_blocks(self.rect, swept.union(self.rect)):
+            self.collide_y(block)
+        self.asleep = not self.force.x and not self.force.y and self.rect == before
 
 
 class Player(Entity):
@@ -203,168 +620,75 @@ class Player(Entity):
         # jump forces and constants
         self.jump_force = 3.5
         self.gravity_force = 0.5
+        self.walk_speed = 5
         self.actual_jump_force = 0
         self.on_ground = False
         self.additional_force = 0
-        TickEvent.register(self)
-        KeyboardEvent.register(self)
-        CollisionEvent.register(self)
-
-    def notify(self, event):
-        if event.name == "keyboard":
-            # falling down
-            if self.state == EntityState.falling_down:
-                if self.on_ground:
-                    self.actual_jump_force = 0
-                    self.state = EntityState.standing
-                elif event.keyboard_dict.get(self.key_config.key_left) is True:
-                    self.state = EntityState.falling_left
-                elif event.keyboard_dict.get(self.key_config.key_right) is True:
-                    self.state = EntityState.falling_right
-            # falling left
-            elif self.state == EntityState.falling_left:
-                if self.on_ground:
-                    self.actual_jump_force = 0
-                    self.state = EntityState.standing
-                elif event.keyboard_dict.get(self.key_config.key_left) is False:
-                    self.state = EntityState.falling_down
-                elif event.keyboard_dict.get(self.key_config.key_right) is True:
-                    self.state = EntityState.falling_right
-            # falling right
-            elif self.state == EntityState.falling_right:
-                if self.on_ground:
-                    self.actual_jump_force = 0
-                    self.state = EntityState.standing
-                elif event.keyboard_dict.get(self.key_config.key_right) is False:
-                    self.state = EntityState.falling_down
-                elif event.keyboard_dict.get(self.key_config.key_left) is True:
-                    self.state = EntityState.falling_left
-            # jumping up
-            elif self.state == EntityState.jumping_up:
-                if self.actual_jump_force <= 0:
-                    self.actual_jump_force = 0
-                    self.state = EntityState.falling_down
-                elif event.keyboard_dict.get(self.key_config.key_left) is True:
-                    self.state = EntityState.jumping_left
-                elif event.keyboard_dict.get(self.key_config.key_right) is True:
-                    self.state = EntityState.jumping_right
-            # jumping left
-            elif self.state == EntityState.jumping_left:
-                if self.actual_jump_force <= 0:
-                    self.actual_jump_force = 0
-                    self.state = EntityState.falling_left
-                elif event.keyboard_dict.get(self.key_config.key_left) is False:
-                    self.state = EntityState.jumping_up
-                elif event.keyboard_dict.get(self.key_config.key_right) is True:
-                    self.state = EntityState.jumping_right
-            # jumping right
-            elif self.state == EntityState.jumping_right:
-                if self.actual_jump_force <= 0:
-                    self.actual_jump_force = 0
-                    self.state = EntityState.falling_right
-                elif event.keyboard_dict.get(self.key_config.key_right) is False:
-                    self.state = EntityState.jumping_up
-                elif event.keyboard_dict.get(self.key_config.key_left) is True:
-                    self.state = EntityState.jumping_left
-            # walking left
-            elif self.state == EntityState.walking_left:
-                if not self.on_ground:
-                    self.state = EntityState.falling_left
-                elif event.keyboard_dict.get(self.key_config.key_left) is False:
-                    self.state = EntityState.standing
-                elif event.keyboard_dict.get(self.key_config.key_right) is True:
-                    self.state = EntityState.walking_right
-            # walking right
-            elif self.state == EntityState.walking_right:
-                if not self.on_ground:
-                    self.state = EntityState.falling_right
-                elif event.keyboard_dict.get(self.key_config.key_right) is False:
-                    self.state = EntityState.standing
-                elif event.keyboard_dict.get(self.key_config.key_left) is True:
-                    self.state = EntityState.walking_left
-            # standing
-            else:
-                if not self.on_ground:
-                    self.state = EntityState.falling_down
-                elif event.keyboard_dict.get(self.key_config.key_up) is True:
-                    self.actual_jump_force = self.jump_force
-                    self.state = EntityState.jumping_up
-                    self.on_ground = False
-                elif event.keyboard_dict.get(self.key_config.key_left) is True:
-                    self.state = EntityState.walking_left
-                    self.on_ground = False
-                elif event.keyboard_dict.get(self.key_config.key_right) is True:
-                    self.state = EntityState.walking_right
-                    self.on_ground = False
-        elif event.name == "collision":
-            #self.on_ground = False
-            if event.objects[1].direction == event.objects[1].DirectionState.left:
-                self.additional_force = -event.objects[1].speed
-            else:
-                self.additional_force = event.objects[1].speed
+        # moving block stood on during the last tick
+        self.platform = None
+        # input mask of the last keyboard event, a change wakes the player
+        self.last_mask = None
+        EventManager.subscribe(KeyboardEvent, self.on_keyboard)
+
+    def record_state(self):
+        return super().record_state() + (self.actual_jump_force, self.on_ground, self.additional_force)
+
+    def restore_state(self, values):
+        super().restore_state(values)
+        self.actual_jump_force = values[7]
+        self.on_ground = bool(values[8])
+        self.additional_force = values[9]
+
+    def input_mask(self, keyboard_dict):
+        # bit layout of player_machine()
+        mask = 0
+        if self.on_ground:
+            mask |= 1
+        if self.actual_jump_force <= 0:
+            mask |= 2
+        if keyboard_dict.get(self.key_config.key_up) is True:
+            mask |= 4
+        key = keyboard_dict.get(self.key_config.key_left)
+        if key is True:
+            mask |= 8
+        elif key is False:
+            mask |= 16
+        key = keyboard_dict.get(self.key_config.key_right)
+        if key is True:
+            mask |= 32
+        elif key is False:
+            mask |= 64
+        return mask
+
+    def on_keyboard(self, event):
+        self.apply_keys(event.keyboard_dict)
+
+    def apply_keys(self, keyboard_dict):
+        mask = self.input_mask(keyboard_dict)
+        if mask == self.last_mask and self.asleep:
+            # the same input leads to the same state it fell asleep in
+            return
+        self.last_mask = mask
+        self.wake()
+        self.machine.step(self, mask)
 
     def set_force(self):
-        # falling down
-        if self.state == EntityState.falling_down:
-            self.force.x = 0
-            self.force.y += self.gravity_force
-        # falling left
-        elif self.state == EntityState.falling_left:
-            self.force.x = -5
-            self.force.y += self.gravity_force
-        # falling right
-        elif self.state == EntityState.falling_right:
-            self.force.x = 5
-            self.force.y += self.gravity_force
-        # jumping up
-        elif self.state == EntityState.jumping_up:
-            self.force.x = 0
-            self.force.y -= self.actual_jump_force
-            self.actual_jump_force -= self.gravity_force
-        # jumping left
-        elif self.state == EntityState.jumping_left:
-            self.force.x = -5
-            self.force.y -= self.actual_jump_force
-            self.actual_jump_force -= self.gravity_force
-        # jumping right
-        elif self.state == EntityState.jumping_right:
-            self.force.x = 5
-            self.force.y -= self.actual_jump_force
-            self.actual_jump_force -= self.gravity_force
-        # walking left
-        elif self.state == EntityState.walking_left:
-            self.force.y = 0
-            self.force.x = -5
-        # walking right
-        elif self.state == EntityState.walking_right:
-            self.force.y = 0
-            self.force.x = 5
-        # standing
-        else:
-            self.force.x = 0
-            self.force.y = 0
+        self.machine.apply_force(self)
+        # carried along by the platform stood on
+        if self.platform is not None:
+            self.additional_force = self.platform.velocity.x
         self.force.x += self.additional_force
 
     def collide_x(self, block):
-        if isinstance(block, MovingBlock):
-            if block.direction == block.DirectionState.left:
-                if self.force.x + block.speed <= 0:
-                    self.state = EntityState.standing
-                    self.rect.left = block.rect.right
-                    self.force.x = 0
-                elif self.force.x + block.speed >= 0:
-                    self.state = EntityState.standing
-                    self.rect.right = block.rect.left
-                    self.force.x = 0
-            elif block.direction == block.DirectionState.right:
-                if self.force.x - block.speed <= 0:
-                    self.state = EntityState.standing
-                    self.rect.left = block.rect.right
-                    self.force.x = 0
-                elif self.force.x - block.speed >= 0:
-                    self.state = EntityState.standing
-                    self.rect.right = block.rect.left
-                    self.force.x = 0
+        if block.moving:
+            if self.force.x - block.velocity.x <= 0:
+                self.state = EntityState.standing
+                self.rect.left = block.rect.right
+                self.force.x = 0
+            else:
+                self.state = EntityState.standing
+                self.rect.right = block.rect.left
+                self.force.x = 0
         else:
             if self.force.x < 0:
                 self.state = EntityState.standing
@@ -381,40 +705,39 @@ class Player(Entity):
             self.rect.top = block.rect.bottom
             self.force.y = 0
         elif self.force.y > 0:
+            EventManager.generate_event(LandedEvent, self, self.rect.centerx, block.rect.top, self.force.y)
             self.on_ground = True
             self.force.y = 0
             self.state = EntityState.standing
             self.rect.bottom = block.rect.top
 
     def check_falling(self):
-        temp_rect = copy.deepcopy(self.rect)
-        temp_rect.y = self.rect.y + 1
-        for layer in range(5):
-            for block in world.blocks[layer]:
-                if temp_rect.colliderect(block):
-                    if isinstance(block, MovingBlock):
-                        EventManager.generate_event(CollisionEvent(self, block))
-                    return False
-        else:
-            return True
+        temp_rect = self.rect.move(0, 1)
+        if world.tilemaps and world.on_tiles(temp_rect):
+            # standing on tiles, which are static
+            return False
+        for block in world.colliding_blocks(temp_rect, temp_rect):
+            if block.moving:
+                self.platform = block
+            return False
+        return True
 
     def physic(self):
         # moving and collisions
         self.set_force()
+        self.platform = None
+        before = swept = self.rect.copy()
         self.move_x()
-        for layer in range(5):
-            for block in world.blocks[layer]:
-                if self.rect.colliderect(block):
-                    self.on_ground = False
-                    self.collide_x(block)
+        for block in world.colliding_blocks(self.rect, swept.union(self.rect)):
+            self.on_ground = False
+            self.collide_x(block)
+        swept = self.rect.copy()
         self.move_y()
-        for layer in range(5):
-            for block in world.blocks[layer]:
-                if self.rect.colliderect(block):
-                    if isinstance(block, MovingBlock):
-                        EventManager.generate_event(CollisionEvent(self, block))
-                    self.on_ground = False
-                    self.collide_y(block)
+        for block in world.colliding_blocks(self.rect, swept.union(self.rect)):
+            if block.moving:
+                self.platform = block
+            self.on_ground = False
+            self.collide_y(block)
         # checking falling
         if self.check_falling():
             if (self.state != EntityState.jumping_up and self.state != EntityState.jumping_left and
@@ -427,6 +750,596 @@ class Player(Entity):
             # self.actual_jump_force = 0
         # additional force for moving platforms
         self.additional_force = 0
+        # standing still on a static block, nothing changes until input or the world does
+        self.asleep = (self.state is EntityState.standing and self.on_ground and self.platform is None and
+                       not self.force.x and not self.force.y and self.rect == before)
+
+
+def stop_jump(entity):
+    entity.actual_jump_force = 0
+
+
+def start_jump(entity):
+    entity.actual_jump_force = entity.jump_force
+    entity.on_ground = False
+
+
+def leave_ground(entity):
+    entity.on_ground = False
+
+
+def falling_force(direction):
+    def force(entity):
+        entity.force.x = direction*entity.walk_speed
+        entity.force.y += entity.gravity_force
+    return force
+
+
+def jumping_force(direction):
+    def force(entity):
+        entity.force.x = direction*entity.walk_speed
+        entity.force.y -= entity.actual_jump_force
+        entity.actual_jump_force -= entity.gravity_force
+    return force
+
+
+def walking_force(direction):
+    def force(entity):
+        entity.force.y = 0
+        entity.force.x = direction*entity.walk_speed
+    return force
+
+
+def standing_force(entity):
+    entity.force.x = 0
+    entity.force.y = 0
+
+
+def player_machine():
+    # bits in the same order as Player.input_mask
+    machine = StateMachine(EntityState, ("on_ground", "jump_spent", "up_pressed", "left_pressed", "left_released",
+                                         "right_pressed", "right_released"))
+    # falling down
+    machine.transition(EntityState.falling_down, EntityState.standing, when=("on_ground",), action=stop_jump)
+    machine.transition(EntityState.falling_down, EntityState.falling_left, when=("left_pressed",))
+    machine.transition(EntityState.falling_down, EntityState.falling_right, when=("right_pressed",))
+    machine.force(EntityState.falling_down, falling_force(0))
+    # falling left
+    machine.transition(EntityState.falling_left, EntityState.standing, when=("on_ground",), action=stop_jump)
+    machine.transition(EntityState.falling_left, EntityState.falling_down, when=("left_released",))
+    machine.transition(EntityState.falling_left, EntityState.falling_right, when=("right_pressed",))
+    machine.force(EntityState.falling_left, falling_force(-1))
+    # falling right
+    machine.transition(EntityState.falling_right, EntityState.standing, when=("on_ground",), action=stop_jump)
+    machine.transition(EntityState.falling_right, EntityState.falling_down, when=("right_released",))
+    machine.transition(EntityState.falling_right, EntityState.falling_left, when=("left_pressed",))
+    machine.force(EntityState.falling_right, falling_force(1))
+    # jumping up
+    machine.transition(EntityState.jumping_up, EntityState.falling_down, when=("jump_spent",), action=stop_jump)
+    machine.transition(EntityState.jumping_up, EntityState.jumping_left, when=("left_pressed",))
+    machine.transition(EntityState.jumping_up, EntityState.jumping_right, when=("right_pressed",))
+    machine.force(EntityState.jumping_up, jumping_force(0))
+    # jumping left
+    machine.transition(EntityState.jumping_left, EntityState.falling_left, when=("jump_spent",), action=stop_jump)
+    machine.transition(EntityState.jumping_left, EntityState.jumping_up, when=("left_released",))
+    machine.transition(EntityState.jumping_left, EntityState.jumping_right, when=("right_pressed",))
+    machine.force(EntityState.jumping_left, jumping_force(-1))
+    # jumping right
+    machine.transition(EntityState.jumping_right, EntityState.falling_right, when=("jump_spent",), action=stop_jump)
+    machine.transition(EntityState.jumping_right, EntityState.jumping_up, when=("right_released",))
+    machine.transition(EntityState.jumping_right, EntityState.jumping_left, when=("left_pressed",))
+    machine.force(EntityState.jumping_right, jumping_force(1))
+    # walking left
+    machine.transition(EntityState.walking_left, EntityState.falling_left, unless=("on_ground",))
+    machine.transition(EntityState.walking_left, EntityState.standing, when=("left_released",))
+    machine.transition(EntityState.walking_left, EntityState.walking_right, when=("right_pressed",))
+    machine.force(EntityState.walking_left, walking_force(-1))
+    # walking right
+    machine.transition(EntityState.walking_right, EntityState.falling_right, unless=("on_ground",))
+    machine.transition(EntityState.walking_right, EntityState.standing, when=("right_released",))
+    machine.transition(EntityState.walking_right, EntityState.walking_left, when=("left_pressed",))
+    machine.force(EntityState.walking_right, walking_force(1))
+    # standing
+    machine.transition(EntityState.standing, EntityState.falling_down, unless=("on_ground",))
+    machine.transition(EntityState.standing, EntityState.jumping_up, when=("up_pressed",), action=start_jump)
+    machine.transition(EntityState.standing, EntityState.walking_left, when=("left_pressed",), action=leave_ground)
+    machine.transition(EntityState.standing, EntityState.walking_right, when=("right_pressed",), action=leave_ground)
+    machine.force(EntityState.standing, standing_force)
+    return machine.compile()
+
+
+Player.machine = player_machine()
+
+
+class EntityStore:
+
+    def __init__(self, capacity=1024, gravity=0.5, max_fall=20, cell_size=128, layer=2):
+        if numpy is None:
+            raise RuntimeError("EntityStore needs numpy")
+        self.layer = layer
+        self.gravity = gravity
+        self.max_fall = max_fall
+        self.cell_size = cell_size
+        self.count = 0
+        # one row per entity, rows [0, count) are in use
+        self.x = numpy.zeros(capacity)
+        self.y = numpy.zeros(capacity)
+        self.width = numpy.zeros(capacity)
+        self.height = numpy.zeros(capacity)
+        self.force_x = numpy.zeros(capacity)
+        self.force_y = numpy.zeros(capacity)
+        self.state = numpy.full(capacity, EntityState.standing.value, numpy.int8)
+        self.visible = numpy.ones(capacity, bool)
+        self.previous_x = numpy.zeros(capacity)
+        self.previous_y = numpy.zeros(capacity)
+        self.entities = []
+        # static colliders, rebuilt when the world's static blocks change
+        self.colliders_version = None
+        self.blocks = None
+        self.cells = None
+
+    def grow(self):
+        capacity = 2*len(self.x)
+        for name in ("x", "y", "width", "height", "force_x", "force_y", "state", "visible",
+                     "previous_x", "previous_y"):
+            old = getattr(self, name)
+            new = numpy.zeros(capacity, old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def allocate(self, entity):
+        if self.count == len(self.x):
+            self.grow()
+        row = self.count
+        self.count += 1
+        self.entities.append(entity)
+        self.state[row] = EntityState.standing.value
+        self.visible[row] = True
+        return row
+
+    def remove(self, entity):
+        # the last row moves into the hole
+        row, last = entity.row, self.count - 1
+        if row != last:
+            for column in (self.x, self.y, self.width, self.height, self.force_x, self.force_y, self.state,
+                           self.visible, self.previous_x, self.previous_y):
+                column[row] = column[last]
+            self.entities[row] = self.entities[last]
+            self.entities[row].row = row
+        self.entities.pop()
+        self.count -= 1
+        entity.row = None
+
+    def update_colliders(self, world, extent):
+        # extent is how far an entity reaches in a step, its size plus its force
+        if self.colliders_version == world.static_version and self.cells is not None and extent <= self.size:
+            return
+        self.colliders_version = world.static_version
+        blocks = [block.rect for layer in range(5) for block in world.blocks[layer] if not block.moving]
+        # cells are at least as large as every entity's reach, so a step touches 2x2 cells at most
+        self.size = size = max(self.cell_size, int(extent) + 1)
+        # the last collider is a sentinel far away from everything, used to pad the cells
+        rects = numpy.array([tuple(rect) for rect in blocks] + [(-10**9, -10**9, 0, 0)], float).reshape(-1, 4)
+        self.blocks = rects
+        if blocks:
+            self.origin_x = int(rects[:-1, 0].min()) // size
+            self.origin_y = int(rects[:-1, 1].min()) // size
+            self.cells_x = int((rects[:-1, 0] + rects[:-1, 2]).max()) // size - self.origin_x + 1
+            self.cells_y = int((rects[:-1, 1] + rects[:-1, 3]).max()) // size - self.origin_y + 1
+        else:
+            self.origin_x = self.origin_y = 0
+            self.cells_x = self.cells_y = 1
+        cells = [[] for _ in range(self.cells_x*self.cells_y)]
+        for index, rect in enumerate(blocks):
+            for cell_x in range(rect.left // size, (rect.right - 1) // size + 1):
+                for cell_y in range(rect.top // size, (rect.bottom - 1) // size + 1):
+                    cells[(cell_x - self.origin_x)*self.cells_y + cell_y - self.origin_y].append(index)
+        depth = max(1, max(len(cell) for cell in cells))
+        self.cells = numpy.full((len(cells), depth), len(blocks), numpy.intp)
+        for index, cell in enumerate(cells):
+            self.cells[index, :len(cell)] = cell
+
+    def candidates(self, x, y):
+        # left, top, right, bottom of the colliders in the 2x2 cells from each (x, y) on
+        cell_x = numpy.clip((x // self.size).astype(numpy.intp) - self.origin_x, 0, self.cells_x - 1)
+        cell_y = numpy.clip((y // self.size).astype(numpy.intp) - self.origin_y, 0, self.cells_y - 1)
+        next_x = numpy.minimum(cell_x + 1, self.cells_x - 1)
+        next_y = numpy.minimum(cell_y + 1, self.cells_y - 1)
+        candidates = numpy.concatenate((self.cells[cell_x*self.cells_y + cell_y], self.cells[next_x*self.cells_y + cell_y],
+                                        self.cells[cell_x*self.cells_y + next_y], self.cells[next_x*self.cells_y + next_y]),
+                                       axis=1)
+        blocks = self.blocks[candidates]
+        left, top = blocks[..., 0], blocks[..., 1]
+        return left, top, left + blocks[..., 2], top + blocks[..., 3]
+
+    @staticmethod
+    def contacts(x, y, width, height, left, top, right, bottom):
+        # (entity, candidate) overlap matrix
+        return ((x[:, None] < right) & (x[:, None] + width[:, None] > left) &
+                (y[:, None] < bottom) & (y[:, None] + height[:, None] > top))
+
+    def step(self, world):
+        count = self.count
+        if not count:
+            return
+        x, y = self.x[:count], self.y[:count]
+        width, height = self.width[:count], self.height[:count]
+        force_x, force_y = self.force_x[:count], self.force_y[:count]
+        force_y += self.gravity
+        numpy.minimum(force_y, self.max_fall, out=force_y)
+        self.update_colliders(world, max((width + numpy.abs(force_x)).max(), (height + numpy.abs(force_y)).max()))
+        # the candidates around the whole move serve both passes
+        corner_x, corner_y = x + numpy.minimum(force_x, 0), y + numpy.minimum(force_y, 0)
+        left, top, right, bottom = self.candidates(corner_x, corner_y)
+        # horizontal pass, only rows moving sideways can hit anything new
+        x += force_x
+        moving = numpy.flatnonzero(force_x)
+        if len(moving):
+            moving_x, moving_left, moving_right = force_x[moving], left[moving], right[moving]
+            overlap = self.contacts(x[moving], y[moving], width[moving], height[moving],
+                                    moving_left, top[moving], moving_right, bottom[moving])
+            hit = overlap.any(axis=1)
+            stop = hit & (moving_x > 0)
+            x[moving[stop]] = numpy.where(overlap, moving_left, numpy.inf).min(axis=1)[stop] - width[moving[stop]]
+            stop = hit & (moving_x < 0)
+            x[moving[stop]] = numpy.where(overlap, moving_right, -numpy.inf).max(axis=1)[stop]
+            # an entity which started inside a block can be pushed out of its swept area,
+            # its candidates are gathered again around where it ended up
+            moved = moving[(x[moving] < corner_x[moving]) | (x[moving] > corner_x[moving] + numpy.abs(moving_x))]
+            if len(moved):
+                left[moved], top[moved], right[moved], bottom[moved] = self.candidates(x[moved], corner_y[moved])
+        # vertical pass
+        y += force_y
+        overlap = self.contacts(x, y, width, height, left, top, right, bottom)
+        hit = overlap.any(axis=1)
+        landed = hit & (force_y > 0)
+        y[landed] = numpy.where(overlap, top, numpy.inf).min(axis=1)[landed] - height[landed]
+        stop = hit & (force_y < 0)
+        y[stop] = numpy.where(overlap, bottom, -numpy.inf).max(axis=1)[stop]
+        force_y[hit] = 0
+        # states
+        state = self.state[:count]
+        state[:] = EntityState.falling_down.value
+        state[landed] = EntityState.standing.value
+        state[landed & (force_x < 0)] = EntityState.walking_left.value
+        state[landed & (force_x > 0)] = EntityState.walking_right.value
+
+    def in_view(self, view, alpha=1.0):
+        # rows whose rect touches view; when interpolating, rows whose previous or current rect
+        # does, so the interpolated one between them is covered
+        count = self.count
+        x, y = self.x[:count], self.y[:count]
+        previous_x, previous_y = (self.previous_x[:count], self.previous_y[:count]) if alpha < 1 else (x, y)
+        return numpy.flatnonzero(self.visible[:count] &
+                                 (numpy.minimum(x, previous_x) < view.right) &
+                                 (numpy.maximum(x, previous_x) + self.width[:count] > view.left) &
+                                 (numpy.minimum(y, previous_y) < view.bottom) &
+                                 (numpy.maximum(y, previous_y) + self.height[:count] > view.top))
+
+    def save_positions(self):
+        self.previous_x[:self.count] = self.x[:self.count]
+        self.previous_y[:self.count] = self.y[:self.count]
+
+    def render(self, alpha=1.0, surface=None):
+        count = self.count
+        x, y = self.x[:count], self.y[:count]
+        if alpha < 1:
+            x = self.previous_x[:count] + (x - self.previous_x[:count])*alpha
+            y = self.previous_y[:count] + (y - self.previous_y[:count])*alpha
+        view = camera.state
+        visible = numpy.flatnonzero(self.visible[:count] &
+                                    (x < view.right) & (x + self.width[:count] > view.left) &
+                                    (y < view.bottom) & (y + self.height[:count] > view.top))
+        screen_x = x[visible].astype(int) - view.x
+        screen_y = y[visible].astype(int) - view.y
+        entities = self.entities
+        (surface or game.screen).blits([image_blit(entities[row].image, (left, top)) for row, left, top
+                                        in zip(visible.tolist(), screen_x.tolist(), screen_y.tolist())],
+                                       doreturn=False)
+
+
+def write_through(method):
+    # an in place method of a stored rect or force which writes the change back to the store
+    def wrapper(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        self.write_back()
+        return result
+    return wrapper
+
+
+class StoredRect(Rect):
+
+    # the rect of a StoredEntity, changes go back to its row in the store;
+    # only the fields that changed are written, positions keep their fractions otherwise;
+    # copies such as move() or copy() are plain rects of this type, not tied to the store
+
+    def __init__(self, entity, *args):
+        super().__init__(*args)
+        self.__dict__.update(entity=entity, written=tuple(self))
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        self.write_back()
+
+    def write_back(self):
+        entity = self.__dict__.get("entity")
+        if entity is None:
+            return
+        store, row = entity.store, entity.row
+        current = tuple(self)
+        for column, old, new in zip((store.x, store.y, store.width, store.height), self.written, current):
+            if old != new:
+                column[row] = new
+        self.__dict__["written"] = current
+
+    __setitem__ = write_through(Rect.__setitem__)
+    clamp_ip = write_through(Rect.clamp_ip)
+    inflate_ip = write_through(Rect.inflate_ip)
+    move_ip = write_through(Rect.move_ip)
+    normalize = write_through(Rect.normalize)
+    scale_by_ip = write_through(Rect.scale_by_ip)
+    union_ip = write_through(Rect.union_ip)
+    unionall_ip = write_through(Rect.unionall_ip)
+    update = write_through(Rect.update)
+
+
+class StoredVector(pygame.math.Vector2):
+
+    # the force of a StoredEntity, changes go back to its row in the store
+
+    def __init__(self, entity, *args):
+        super().__init__(*args)
+        self.__dict__["entity"] = entity
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        self.write_back()
+
+    def write_back(self):
+        entity = self.__dict__.get("entity")
+        if entity is not None:
+            entity.store.force_x[entity.row], entity.store.force_y[entity.row] = self
+
+    __setitem__ = write_through(pygame.math.Vector2.__setitem__)
+    __iadd__ = write_through(pygame.math.Vector2.__iadd__)
+    __isub__ = write_through(pygame.math.Vector2.__isub__)
+    __imul__ = write_through(pygame.math.Vector2.__imul__)
+    __itruediv__ = write_through(pygame.math.Vector2.__itruediv__)
+    __ifloordiv__ = write_through(pygame.math.Vector2.__ifloordiv__)
+    clamp_magnitude_ip = write_through(pygame.math.Vector2.clamp_magnitude_ip)
+    move_towards_ip = write_through(pygame.math.Vector2.move_towards_ip)
+    normalize_ip = write_through(pygame.math.Vector2.normalize_ip)
+    reflect_ip = write_through(pygame.math.Vector2.reflect_ip)
+    rotate_ip = write_through(pygame.math.Vector2.rotate_ip)
+    rotate_rad_ip = write_through(pygame.math.Vector2.rotate_rad_ip)
+    scale_to_length = write_through(pygame.math.Vector2.scale_to_length)
+    update = write_through(pygame.math.Vector2.update)
+
+
+class StoredEntity(Entity):
+
+    # an Entity whose rect, force and state live in an EntityStore; rect and force are
+    # proxies writing through to the store, so entity.rect.x += 5 works as on an Entity
+    # physics run for the whole store at once in EntityStore.step
+
+    def __init__(self, store, x, y, width, height):
+        self.store = store
+        self.row = store.allocate(self)
+        super().__init__(x, y, width, height)
+        self.state = EntityState.falling_down
+
+    @property
+    def rect(self):
+        store, row = self.store, self.row
+        return StoredRect(self, int(store.x[row]), int(store.y[row]), int(store.width[row]), int(store.height[row]))
+
+    @rect.setter
+    def rect(self, rect):
+        store, row = self.store, self.row
+        store.x[row], store.y[row], store.width[row], store.height[row] = rect
+
+    @property
+    def force(self):
+        return StoredVector(self, self.store.force_x[self.row], self.store.force_y[self.row])
+
+    @force.setter
+    def force(self, force):
+        self.store.force_x[self.row], self.store.force_y[self.row] = force
+
+    @property
+    def state(self):
+        return EntityState(int(self.store.state[self.row]))
+
+    @state.setter
+    def state(self, state):
+        self.store.state[self.row] = state.value
+
+    @property
+    def visible(self):
+        return bool(self.store.visible[self.row])
+
+    @visible.setter
+    def visible(self, visible):
+        self.store.visible[self.row] = visible
+
+    def restore_state(self, values):
+        self.rect = Rect(*(int(value) for value in values[:4]))
+        self.force = (values[4], values[5])
+        self.state = EntityState(int(values[6]))
+
+    def physic(self):
+        pass
+
+
+class ParticleSystem:
+
+    def __init__(self, capacity=65536, layer=3, gravity=0.2, drag=0.98, size=2, seed=None):
+        if numpy is None:
+            raise RuntimeError("ParticleSystem needs numpy")
+        self.layer = layer
+        self.gravity = gravity
+        self.drag = drag
+        # particles are size x size squares
+        self.size = size
+        self.rng = numpy.random.default_rng(seed)
+        self.count = 0
+        # rows [0, count) are alive
+        self.x = numpy.zeros(capacity)
+        self.y = numpy.zeros(capacity)
+        self.vx = numpy.zeros(capacity)
+        self.vy = numpy.zeros(capacity)
+        self.life = numpy.zeros(capacity)
+        self.lifetime = numpy.ones(capacity)
+        self.color = numpy.zeros((capacity, 3), numpy.uint8)
+
+    def emit(self, count, x, y, speed=(1, 4), angle=(0, 2*math.pi), life=(20, 60), color=(255, 255, 255),
+             color_jitter=0):
+        # count particles at (x, y) flying off in a random direction within angle (radians,
+        # 0 is right, pi/2 down) at a random speed; particles over capacity are dropped
+        start = self.count
+        count = min(count, len(self.x) - start)
+        if count <= 0:
+            return
+        end = start + count
+        rng = self.rng
+        directions = rng.uniform(angle[0], angle[1], count)
+        speeds = rng.uniform(speed[0], speed[1], count)
+        self.x[start:end] = x
+        self.y[start:end] = y
+        self.vx[start:end] = numpy.cos(directions)*speeds
+        self.vy[start:end] = numpy.sin(directions)*speeds
+        self.life[start:end] = self.lifetime[start:end] = rng.integers(life[0], life[1], count, endpoint=True)
+        colors = numpy.tile(numpy.array(tuple(pygame.Color(color))[:3], numpy.int16), (count, 1))
+        if color_jitter:
+            colors += rng.integers(-color_jitter, color_jitter, (count, 3), endpoint=True, dtype=numpy.int16)
+        self.color[start:end] = numpy.clip(colors, 0, 255)
+        self.count = end
+
+    def step(self):
+        count = self.count
+        if not count:
+            return
+        vx, vy = self.vx[:count], self.vy[:count]
+        vy += self.gravity
+        vx *= self.drag
+        vy *= self.drag
+        self.x[:count] += vx
+        self.y[:count] += vy
+        life = self.life[:count]
+        life -= 1
+        alive = life > 0
+        if not alive.all():
+            # survivors move to the front in their order
+            kept = int(alive.sum())
+            for column in (self.x, self.y, self.vx, self.vy, self.life, self.lifetime, self.color):
+                column[:kept] = column[:count][alive]
+            self.count = kept
+
+    def draw(self, surface, alpha=1.0):
+        count = self.count
+        if not count:
+            return
+        view = camera.state
+        # positions between the last two ticks
+        x = self.x[:count] - self.vx[:count]*(1 - alpha) - view.x
+        y = self.y[:count] - self.vy[:count]*(1 - alpha) - view.y
+        width, height = surface.get_size()
+        visible = (x >= 0) & (x < width - self.size) & (y >= 0) & (y < height - self.size)
+        screen_x = x[visible].astype(numpy.intp)
+        screen_y = y[visible].astype(numpy.intp)
+        # fading out towards the end of their lives
+        fade = (self.life[:count][visible] / self.lifetime[:count][visible])[:, None]
+        colors = (self.color[:count][visible]*fade).astype(numpy.uint8)
+        pixels = pygame.surfarray.pixels3d(surface)
+        for dx in range(self.size):
+            for dy in range(self.size):
+                pixels[screen_x + dx, screen_y + dy] = colors
+        del pixels
+
+    def render(self, alpha=1.0, surface=None):
+        target = surface or game.screen
+        if isinstance(target, pygame.Surface):
+            self.draw(target, alpha)
+            return
+        # recorded targets keep what they are given, so the particles get a surface of their own
+        layer = pygame.Surface(game.screen.get_size())
+        layer.set_colorkey((0, 0, 0))
+        self.draw(layer, alpha)
+        target.blit(layer, (0, 0))
+
+    def emit_on_landing(self, min_speed=4, count=20, color=(160, 140, 110)):
+        # dust where entities come down hard
+        def on_landed(event):
+            if event.speed >= min_speed:
+                self.emit(int(count*event.speed/min_speed), event.x, event.y, speed=(0.5, 2.5),
+                          angle=(math.pi, 2*math.pi), life=(10, 30), color=color, color_jitter=20)
+        EventManager.subscribe(LandedEvent, on_landed)
+        return on_landed
+
+
+class Emitter:
+
+    # emits rate particles per tick from the center of an entity until detached
+
+    def __init__(self, system, entity, rate, **spray):
+        self.system = system
+        self.entity = entity
+        self.rate = rate
+        # keyword arguments of ParticleSystem.emit
+        self.spray = spray
+        self.due = 0.0
+        EventManager.subscribe(TickEvent, self.on_tick)
+
+    def on_tick(self, event):
+        self.due += self.rate
+        count = int(self.due)
+        if count:
+            self.due -= count
+            self.system.emit(count, *self.entity.rect.center, **self.spray)
+
+    def detach(self):
+        EventManager.unsubscribe(TickEvent, self.on_tick)
+
+
+class FontRegistry:
+
+    def __init__(self, fallback="arial"):
+        self.fallback = fallback
+        self.available = None
+        self.fonts = dict()
+
+    def get(self, name, size):
+        font = self.fonts.get((name, size))
+        if font is None:
+            # the system font scan is slow, it runs once per process
+            if self.available is None:
+                self.available = set(pygame.font.get_fonts())
+            font = pygame.font.SysFont(name if name in self.available else self.fallback, size)
+            self.fonts[(name, size)] = font
+        return font
+
+
+class TextCache:
+
+    def __init__(self, capacity=512):
+        self.capacity = capacity
+        self.surfaces = OrderedDict()
+
+    def render(self, font, text, antialias, color, background=None):
+        key = (font, text, antialias, tuple(color), None if background is None else tuple(background))
+        surface = self.surfaces.get(key)
+        if surface is None:
+            surface = font.render(text, antialias, color, background)
+            self.surfaces[key] = surface
+            if len(self.surfaces) > self.capacity:
+                self.surfaces.popitem(last=False)
+        else:
+            self.surfaces.move_to_end(key)
+        return surface
+
+
+fonts = FontRegistry()
+text_cache = TextCache()
 
 
 class GUI(GameObject):
@@ -437,8 +1350,23 @@ class GUI(GameObject):
         self.layer = 4
         self.solid = False
 
-    def render(self):
-        game.screen.blit(self.image, self.rect)
+    def invalidate(self):
+        super().invalidate()
+        world.invalidate_gui(self)
+
+    def screen_rect(self, alpha=1.0):
+        return Rect(self.rect.topleft, self.image.get_size())
+
+    def draw(self, surface, origin=(0, 0)):
+        # origin is the screen position of the surface's top left corner
+        rect = self.screen_rect()
+        surface.blit(self.image, (rect.x - origin[0], rect.y - origin[1]))
+
+    def render(self, alpha=1.0, surface=None):
+        self.draw(surface or game.screen)
+
+    def on_click(self, event):
+        pass
 
 
 class Button(GUI):
@@ -451,65 +1379,52 @@ class Button(GUI):
         self.f_color = f_color
         self.font_name = font_name
         self.font_size = font_size
-        if self.font_name in pygame.font.get_fonts():
-            self.font = pygame.font.SysFont(self.font_name, self.font_size)
-        else:
-            self.font = pygame.font.SysFont("arial", self.font_size)
+        self.font = fonts.get(self.font_name, self.font_size)
         # text
-        self.rendered_text = self.font.render(self.text, True, self.f_color, None)
+        self.rendered_text = text_cache.render(self.font, self.text, True, self.f_color)
         self.text_pos = self.rendered_text.get_rect()
         self.text_pos.center = (self.rect.x + self.rect.width/2, self.rect.y + self.rect.height/2)
         # helpful rectangles
         self.upper_rect = Rect(self.rect.x + self.r, self.rect.y, self.rect.width - 2*self.r, self.r)
         self.middle_rect = Rect(self.rect.x, self.rect.y + self.r, self.rect.width, self.rect.height - 2*self.r)
         self.lower_rect = Rect(self.rect.x + self.r, self.rect.y + self.rect.height - self.r, self.rect.width - 2*self.r, self.r)
-        LMBClickEvent.register(self)
-
-    def notify(self, event):
-        if event.name == "lmb_click":
-            if self.clicked(event.mouse_x, event.mouse_y):
-                EventManager.generate_event(LabelClickedEvent)
-                self.b_color, self.f_color = self.f_color, self.b_color
-                #print("Hip hip array!")
+        # the drawn button covers the rounded rect and the text
+        self.area = self.rect.union(self.text_pos)
+        self.redraw()
+        # hit test mask of the rounded rect
+        shape = pygame.Surface(self.rect.size, SRCALPHA)
+        self.draw_shape(shape, self.rect.topleft, (255, 255, 255))
+        self.mask = pygame.mask.from_surface(shape)
+
+    def draw_shape(self, surface, origin, color):
+        x, y = self.rect.x - origin[0], self.rect.y - origin[1]
+        pygame.draw.rect(surface, color, self.upper_rect.move(-origin[0], -origin[1]))
+        pygame.draw.rect(surface, color, self.middle_rect.move(-origin[0], -origin[1]))
+        pygame.draw.rect(surface, color, self.lower_rect.move(-origin[0], -origin[1]))
+        pygame.draw.circle(surface, color, (x + self.r, y + self.r), self.r)
+        pygame.draw.circle(surface, color, (x + self.rect.width - self.r, y + self.r), self.r)
+        pygame.draw.circle(surface, color, (x + self.r, y + self.rect.height - self.r), self.r)
+        pygame.draw.circle(surface, color, (x + self.rect.width - self.r, y + self.rect.height - self.r), self.r)
+
+    def redraw(self):
+        self.image = pygame.Surface(self.area.size, SRCALPHA)
+        self.draw_shape(self.image, self.area.topleft, tuple(self.b_color)[:3])
+        self.image.blit(self.rendered_text, (self.text_pos.x - self.area.x, self.text_pos.y - self.area.y))
+
+    def on_click(self, event):
+        if self.clicked(event.mouse_x, event.mouse_y):
+            EventManager.generate_event(LabelClickedEvent, self)
+            self.b_color, self.f_color = self.f_color, self.b_color
+            self.redraw()
+            self.invalidate()
+            #print("Hip hip array!")
 
     def clicked(self, mouse_x, mouse_y):
-        if (self.rect.x <= mouse_x <= self.rect.x + self.rect.width and
-                self.rect.y <= mouse_y <= self.rect.y + self.rect.height):
-            if (self.rect.x + self.r <= mouse_x <= self.rect.x + self.rect.width - self.r and
-                    self.rect.y <= mouse_y <= self.rect.y + self.r):
-                return True
-            elif (self.rect.x <= mouse_x <= self.rect.x + self.rect.width and
-                    self.rect.y + self.r <= mouse_y <= self.rect.y - self.r):
-                return True
-            elif (self.rect.x + self.r <= mouse_x <= self.rect.x + self.rect.width - self.r and
-                    self.rect.y + self.rect.height - self.r <= mouse_y <= self.rect.y + self.rect.height):
-                return True
-            elif (self.rect.x + self.r <= mouse_x <= self.rect.x + self.rect.width - self.r and
-                    self.rect.y + self.rect.height - self.r <= mouse_y <= self.rect.y + self.rect.height):
-                return True
-            elif (self.rect.x <= mouse_x <= self.rect.x + self.r and
-                    self.rect.y <= mouse_y <= self.rect.y + self.r and
-                    (self.rect.x + self.r - mouse_x)*(self.rect.x + self.r - mouse_x) + (self.rect.y + self.r - mouse_y)*(self.rect.y + self.r - mouse_y) <= self.r*self.r):
-                return True
-            elif (self.rect.x <= mouse_x <= self.rect.x + self.r and
-                    self.rect.y <= mouse_y <= self.rect.y + self.r and
-                    (self.rect.x + self.r - mouse_x)*(self.rect.x + self.r - mouse_x) + (self.rect.y + self.r - mouse_y)*(self.rect.y + self.r - mouse_y) <= self.r*self.r):
-                return True
-            else:
-                return False
-        else:
-            return False
-
-    def render(self):
+        x, y = mouse_x - self.rect.x, mouse_y - self.rect.y
+        return 0 <= x < self.rect.width and 0 <= y < self.rect.height and self.mask.get_at((x, y)) == 1
 
-        pygame.draw.rect(game.screen, self.b_color, self.upper_rect)
-        pygame.draw.rect(game.screen, self.b_color, self.middle_rect)
-        pygame.draw.rect(game.screen, self.b_color, self.lower_rect)
-        pygame.draw.circle(game.screen, self.b_color, (self.rect.x + self.r, self.rect.y + self.r), self.r)
-        pygame.draw.circle(game.screen, self.b_color, (self.rect.x + self.rect.width - self.r, self.rect.y + self.r), self.r)
-        pygame.draw.circle(game.screen, self.b_color, (self.rect.x + self.r, self.rect.y + self.rect.height - self.r), self.r)
-        pygame.draw.circle(game.screen, self.b_color, (self.rect.x + self.rect.width - self.r, self.rect.y + self.rect.height - self.r), self.r)
-        game.screen.blit(self.rendered_text, self.text_pos)
+    def screen_rect(self, alpha=1.0):
+        return self.area.copy()
 
 
 class Label(GUI):
@@ -518,24 +1433,66 @@ class Label(GUI):
 
     def __init__(self, x, y, width, height, text, b_color, f_color, font_name, font_size):
         super().__init__(x, y, width, height)
-        self.image = pygame.Surface((width, height))
-        self.text = text
-        self.b_color = b_color
-        self.f_color = f_color
+        self._text = text
+        self._b_color = b_color
+        self._f_color = f_color
         self.font_name = font_name
         self.font_size = font_size
-        # checking font
-        print(pygame.font.get_fonts())
-        if self.font_name in pygame.font.get_fonts():
-            self.font = pygame.font.SysFont(self.font_name, self.font_size)
-        else:
-            self.font = pygame.font.SysFont("arial", self.font_size)
-        LMBClickEvent.register(self)
-
-    def notify(self, event):
-        if event.name == "lmb_click":
-            if self.clicked(event.mouse_x, event.mouse_y):
-                EventManager.generate_event(LabelClickedEvent)
+        self.font = fonts.get(self.font_name, self.font_size)
+        # text surface and the composed label, None until the next render
+        self.rendered_text = None
+        self.text_pos = None
+        self.area = None
+
+    @property
+    def text(self):
+        return self._text
+
+    @text.setter
+    def text(self, text):
+        if text != self._text:
+            self._text = text
+            self.rendered_text = None
+            self.image = None
+            self.invalidate()
+
+    @property
+    def b_color(self):
+        return self._b_color
+
+    @b_color.setter
+    def b_color(self, color):
+        if tuple(color) != tuple(self._b_color):
+            self._b_color = color
+            self.image = None
+            self.invalidate()
+
+    @property
+    def f_color(self):
+        return self._f_color
+
+    @f_color.setter
+    def f_color(self, color):
+        if tuple(color) != tuple(self._f_color):
+            self._f_color = color
+            self.rendered_text = None
+            self.image = None
+            self.invalidate()
+
+    def update_text(self):
+        if self.rendered_text is None:
+            self.rendered_text = text_cache.render(self.font, self._text, True, self._f_color)
+            self.text_pos = self.rendered_text.get_rect()
+            self.text_pos.center = (self.rect.x + self.rect.width/2, self.rect.y + self.rect.height/2)
+        if self.image is None:
+            self.area = self.rect.union(self.text_pos)
+            self.image = pygame.Surface(self.area.size, SRCALPHA)
+            self.image.fill(tuple(self._b_color)[:3], self.rect.move(-self.area.x, -self.area.y))
+            self.image.blit(self.rendered_text, (self.text_pos.x - self.area.x, self.text_pos.y - self.area.y))
+
+    def on_click(self, event):
+        if self.clicked(event.mouse_x, event.mouse_y):
+            EventManager.generate_event(LabelClickedEvent, self)
 
     def clicked(self, mouse_x, mouse_y):
         if (self.rect.x <= mouse_x <= self.rect.x + self.rect.width and
@@ -544,12 +1501,9 @@ class Label(GUI):
         else:
             return False
 
-    def render(self):
-        rendered_text = self.font.render(self.text, True, self.f_color, None)
-        text_pos = rendered_text.get_rect()
-        text_pos.center = (self.rect.x + self.rect.width/2, self.rect.y + self.rect.height/2)
-        pygame.draw.rect(game.screen, self.b_color, self.rect)
-        game.screen.blit(rendered_text, text_pos)
+    def screen_rect(self, alpha=1.0):
+        self.update_text()
+        return self.area.copy()
 
 
 class HealthBar(GUI):
@@ -561,138 +1515,1079 @@ class HealthBar(GUI):
         self.layer = layer
 
 
+class PerfHUD(GUI):
+
+    # profiler statistics drawn over the game, redrawn every interval ticks
+
+    def __init__(self, profiler, x=10, y=10, interval=30, font_name="consolas", font_size=14):
+        super().__init__(x, y, 0, 0)
+        self.profiler = profiler
+        self.interval = interval
+        self.font = fonts.get(font_name, font_size)
+        self.ticks = 0
+        self.redraw()
+        EventManager.subscribe(TickEvent, self.on_tick)
+
+    def on_tick(self, event):
+        self.ticks += 1
+        if self.ticks % self.interval == 0:
+            self.redraw()
+            world.gui_grid.move(self)
+            self.invalidate()
+
+    def redraw(self):
+        lines = ["%-24s %7s %7s %7s" % ("", "mean", "p99", "max")]
+        for name in self.profiler.names():
+            mean, median, p99, worst = self.profiler.stats(name)
+            lines.append("%-24s %7.2f %7.2f %7.2f" % (name[:24], mean, p99, worst))
+        rendered = [text_cache.render(self.font, line, True, (255, 255, 255)) for line in lines]
+        width = max(surface.get_width() for surface in rendered) + 8
+        height = sum(surface.get_height() for surface in rendered) + 8
+        self.image = pygame.Surface((width, height), SRCALPHA)
+        self.image.fill((0, 0, 0, 160))
+        y = 4
+        for surface in rendered:
+            self.image.blit(surface, (4, y))
+            y += surface.get_height()
+        self.rect.size = (width, height)
+
+
+class SpatialHash:
+
+    def __init__(self, cell_size=128):
+        self.cell_size = cell_size
+        self.cells = dict()
+        self.keys = dict()
+        # (layer, insertion number) for every object, the order of a full layer scan
+        self.order = dict()
+        self.counter = 0
+        # told about every insert and remove, e.g. VisibleSets
+        self.watchers = []
+
+    def cell_range(self, rect):
+        right = max(rect.right, rect.left + 1) - 1
+        bottom = max(rect.bottom, rect.top + 1) - 1
+        return (rect.left // self.cell_size, rect.top // self.cell_size,
+                right // self.cell_size, bottom // self.cell_size)
+
+    @staticmethod
+    def cells_in(key):
+        for cell_x in range(key[0], key[2] + 1):
+            for cell_y in range(key[1], key[3] + 1):
+                yield cell_x, cell_y
+
+    def insert(self, obj):
+        self.counter += 1
+        self.order[obj] = (obj.layer, self.counter)
+        self.keys[obj] = self.cell_range(obj.rect)
+        for cell in self.cells_in(self.keys[obj]):
+            self.cells.setdefault(cell, set()).add(obj)
+        for watcher in self.watchers:
+            watcher.inserted(obj, self.keys[obj])
+
+    def remove(self, obj):
+        for cell in self.cells_in(self.keys.pop(obj)):
+            self.cells[cell].discard(obj)
+            if not self.cells[cell]:
+                del self.cells[cell]
+        del self.order[obj]
+        for watcher in self.watchers:
+            watcher.removed(obj)
+
+    def move(self, obj):
+        key = self.keys.get(obj)
+        if key is None or key == self.cell_range(obj.rect):
+            return
+        order = self.order[obj]
+        self.remove(obj)
+        self.insert(obj)
+        self.order[obj] = order
+
+    def query(self, rect):
+        found = set()
+        for cell in self.cells_in(self.cell_range(rect)):
+            objects = self.cells.get(cell)
+            if objects:
+                found.update(objects)
+        return sorted(found, key=self.order.__getitem__)
+
+
+class VisibleSet:
+
+    # the objects of a SpatialHash in the cells around the view, kept up to date as the view
+    # and the objects move, so culling touches only what enters or leaves the view;
+    # members are still tested against the exact view when drawn
+
+    def __init__(self, grid, margin=64):
+        self.grid = grid
+        # covers images larger than their rects and interpolation between ticks
+        self.margin = margin
+        self.objects = set()
+        self.range = None
+        grid.watchers.append(self)
+
+    def overlaps(self, key, other):
+        return key[0] <= other[2] and other[0] <= key[2] and key[1] <= other[3] and other[1] <= key[3]
+
+    def inserted(self, obj, key):
+        if self.range is not None and self.overlaps(key, self.range):
+            self.objects.add(obj)
+
+    def removed(self, obj):
+        self.objects.discard(obj)
+
+    def update(self, view):
+        old, new = self.range, self.grid.cell_range(view.inflate(2*self.margin, 2*self.margin))
+        if new == old:
+            return
+        self.range = new
+        cells = self.grid.cells
+        if old is None or not self.overlaps(old, new):
+            self.objects = set()
+            for cell in self.grid.cells_in(new):
+                self.objects.update(cells.get(cell, ()))
+            return
+        keys = self.grid.keys
+        for cell in self.grid.cells_in(old):
+            if not self.overlaps((cell[0], cell[1], cell[0], cell[1]), new):
+                for obj in cells.get(cell, ()):
+                    if not self.overlaps(keys[obj], new):
+                        self.objects.discard(obj)
+        for cell in self.grid.cells_in(new):
+            if not self.overlaps((cell[0], cell[1], cell[0], cell[1]), old):
+                self.objects.update(cells.get(cell, ()))
+
+    def layers(self):
+        # members per layer, in the order of a full layer scan
+        layers = [[] for _ in range(5)]
+        for obj in sorted(self.objects, key=self.grid.order.__getitem__):
+            layers[obj.layer].append(obj)
+        return layers
+
+
+class StaticChunks:
+
+    # pixels of this color are transparent in baked chunks
+    colorkey = (255, 0, 255)
+
+    def __init__(self, chunk_size=512):
+        self.chunk_size = chunk_size
+        self.blocks = [dict() for _ in range(5)]
+        self.surfaces = [dict() for _ in range(5)]
+        self.stale = [set() for _ in range(5)]
+
+    def chunks_in(self, area):
+        size = self.chunk_size
+        for chunk_x in range(area.left // size, (area.right - 1) // size + 1):
+            for chunk_y in range(area.top // size, (area.bottom - 1) // size + 1):
+                yield chunk_x, chunk_y
+
+    def add(self, block):
+        for chunk in self.chunks_in(Rect(block.rect.topleft, block.image.get_size())):
+            self.blocks[block.layer].setdefault(chunk, []).append(block)
+            self.stale[block.layer].add(chunk)
+
+    def remove(self, block):
+        for chunk in self.chunks_in(Rect(block.rect.topleft, block.image.get_size())):
+            self.blocks[block.layer][chunk].remove(block)
+            self.stale[block.layer].add(chunk)
+
+    def bake(self, layer, chunk):
+        blocks = [block for block in self.blocks[layer].get(chunk, ()) if block.visible]
+        if not blocks:
+            self.surfaces[layer].pop(chunk, None)
+            return
+        # a new surface every time, so a chunk that is being drawn is never modified
+        surface = pygame.Surface((self.chunk_size, self.chunk_size))
+        if not game.headless:
+            surface = surface.convert()
+        surface.fill(self.colorkey)
+        surface.set_colorkey(self.colorkey, RLEACCEL)
+        x, y = chunk[0]*self.chunk_size, chunk[1]*self.chunk_size
+        for block in blocks:
+            surface.blit(*image_blit(block.image, (block.rect.x - x, block.rect.y - y)))
+        self.surfaces[layer][chunk] = surface
+
+    def render(self, layer, target=None):
+        for chunk in self.stale[layer]:
+            self.bake(layer, chunk)
+        self.stale[layer].clear()
+        surfaces = self.surfaces[layer]
+        target = target or game.screen
+        for chunk in self.chunks_in(camera.state):
+            surface = surfaces.get(chunk)
+            if surface is not None:
+                target.blit(surface, (chunk[0]*self.chunk_size - camera.state.x,
+                                      chunk[1]*self.chunk_size - camera.state.y))
+
+
+class LevelFile:
+
+    # binary level: header, chunk index, then the blocks of every chunk stored together;
+    # static blocks are cut at chunk borders, a moving block belongs to the chunk of its
+    # initial top left corner and its chunk's bounds cover the stretch it travels along
+    magic = b"PLVL"
+    version = 1
+    # magic, version, level width, level height, chunk size, chunk count
+    header = struct.Struct("<4sHiiiI")
+    # chunk x, chunk y, offset, block count, bounds x, y, width, height
+    chunk = struct.Struct("<iiIIiiii")
+    # kind, layer, x, y, width, height, distance, speed
+    block = struct.Struct("<BBiiiiii")
+    kinds = (SolidBlock, MovingBlock)
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        # pages are read on demand, only the chunks that get loaded are touched
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.level_width, self.level_height, self.chunk_size, count = \
+            self.header.unpack_from(self.data)
+        if magic != self.magic or version != self.version:
+            raise ValueError("%s is not a level file" % path)
+        self.chunks = dict()
+        # chunks whose blocks reach out of their cell, checked on their own by chunks_in
+        self.overhanging = []
+        for index in range(count):
+            chunk_x, chunk_y, offset, blocks, *bounds = self.chunk.unpack_from(
+                self.data, self.header.size + index*self.chunk.size)
+            bounds = Rect(bounds)
+            self.chunks[(chunk_x, chunk_y)] = (offset, blocks, bounds)
+            cell = Rect(chunk_x*self.chunk_size, chunk_y*self.chunk_size, self.chunk_size, self.chunk_size)
+            if not cell.contains(bounds):
+                self.overhanging.append(((chunk_x, chunk_y), bounds))
+
+    @classmethod
+    def save(cls, path, blocks, level_width, level_height, chunk_size=1024):
+        chunks = dict()
+
+        def add(key, record, bounds):
+            records, area = chunks.get(key, ([], None))
+            records.append(record)
+            chunks[key] = (records, bounds if area is None else area.union(bounds))
+
+        for block in blocks:
+            rect = block.rect
+            if block.moving:
+                x, y = block.initial_x, block.initial_y
+                # the whole stretch the block travels along
+                reach = block.distance + block.speed
+                add((x // chunk_size, y // chunk_size),
+                    (1, block.layer, x, y, rect.width, rect.height, block.distance, block.speed),
+                    Rect(x - reach, y, rect.width + 2*reach, rect.height))
+                continue
+            # a static block is stored as the pieces in each chunk it covers, so a long floor
+            # doesn't pull every chunk it crosses into view
+            for chunk_x in range(rect.left // chunk_size, (rect.right - 1) // chunk_size + 1):
+                for chunk_y in range(rect.top // chunk_size, (rect.bottom - 1) // chunk_size + 1):
+                    piece = rect.clip(chunk_x*chunk_size, chunk_y*chunk_size, chunk_size, chunk_size)
+                    add((chunk_x, chunk_y), (0, block.layer, *piece, 0, 0), piece)
+        index = []
+        data = []
+        offset = cls.header.size + len(chunks)*cls.chunk.size
+        for (chunk_x, chunk_y), (records, bounds) in sorted(chunks.items()):
+            index.append(cls.chunk.pack(chunk_x, chunk_y, offset, len(records), *bounds))
+            for record in records:
+                data.append(cls.block.pack(*record))
+            offset += len(records)*cls.block.size
+        with open(path, "wb") as file:
+            file.write(cls.header.pack(cls.magic, cls.version, level_width, level_height, chunk_size, len(chunks)))
+            file.write(b"".join(index))
+            file.write(b"".join(data))
+
+    def chunks_in(self, area):
+        left, right = area.left // self.chunk_size, (area.right - 1) // self.chunk_size
+        top, bottom = area.top // self.chunk_size, (area.bottom - 1) // self.chunk_size
+        for chunk_x in range(left, right + 1):
+            for chunk_y in range(top, bottom + 1):
+                chunk = self.chunks.get((chunk_x, chunk_y))
+                if chunk is not None and area.colliderect(chunk[2]):
+                    yield chunk_x, chunk_y
+        for (chunk_x, chunk_y), bounds in self.overhanging:
+            if not (left <= chunk_x <= right and top <= chunk_y <= bottom) and area.colliderect(bounds):
+                yield chunk_x, chunk_y
+
+    def blocks(self, key):
+        offset, count, bounds = self.chunks[key]
+        for kind, layer, x, y, width, height, distance, speed in self.block.iter_unpack(
+                self.data[offset:offset + count*self.block.size]):
+            if kind:
+                block = MovingBlock(x, y, width, height, distance, speed)
+            else:
+                block = SolidBlock(x, y, width, height)
+            block.layer = layer
+            yield block
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+
+class LevelStreamer:
+
+    # keeps the chunks around the camera view loaded; chunks are read and their blocks built
+    # on a worker thread, the world is only changed from update() on the simulation thread;
+    # chunks in the view itself are never waited for, they load before the tick goes on,
+    # so what the player runs into doesn't depend on how fast the worker is
+
+    def __init__(self, world, level, margin=256):
+        self.world = world
+        self.level = level
+        self.margin = margin
+        self.loaded = dict()
+        self.pending = set()
+        self.wanted = set()
+        self.area_key = None
+        self.required = set()
+        self.view_key = None
+        self.requests = queue.Queue()
+        self.results = queue.Queue()
+        self.thread = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
+
+    def work(self):
+        while True:
+            key = self.requests.get()
+            if key is None:
+                return
+            self.results.put((key, list(self.level.blocks(key))))
+
+    def update(self, view, wait=False):
+        area = view.inflate(2*self.margin, 2*self.margin)
+        size = self.level.chunk_size
+        view_key = (view.left // size, view.top // size, view.right // size, view.bottom // size)
+        if view_key != self.view_key:
+            self.view_key = view_key
+            self.required = set(self.level.chunks_in(view))
+        area_key = (area.left // size, area.top // size, area.right // size, area.bottom // size)
+        if area_key != self.area_key:
+            self.area_key = area_key
+            self.wanted = set(self.level.chunks_in(area))
+            for key in self.wanted - self.loaded.keys() - self.pending:
+                self.pending.add(key)
+                self.requests.put(key)
+            for key in list(self.loaded):
+                if key not in self.wanted:
+                    for block in self.loaded.pop(key):
+                        self.world.remove_block(block)
+        if wait:
+            while self.pending:
+                self.receive(*self.results.get())
+        while True:
+            try:
+                self.receive(*self.results.get_nowait())
+            except queue.Empty:
+                break
+        for key in self.required - self.loaded.keys():
+            if key in self.pending:
+                while key in self.pending:
+                    self.receive(*self.results.get())
+            else:
+                self.receive(key, list(self.level.blocks(key)))
+
+    def receive(self, key, blocks):
+        self.pending.discard(key)
+        # the camera may have moved away while the chunk was loading
+        if key in self.wanted and key not in self.loaded:
+            for block in blocks:
+                self.world.add_block(block)
+            self.loaded[key] = blocks
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
+        for blocks in self.loaded.values():
+            for block in blocks:
+                self.world.remove_block(block)
+        self.loaded.clear()
+        self.level.close()
+
+
+class TileMap:
+
+    # width x height tiles of tile_size pixels, row by row, 0 is empty and anything else solid;
+    # collisions go through the few large blocks colliders() merges the solid tiles into
+
+    def __init__(self, width, height, tile_size=16, x=0, y=0, tiles=None):
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        # pixel position of the top left tile
+        self.x = x
+        self.y = y
+        self.tiles = bytearray(width*height) if tiles is None else bytearray(tiles)
+        # SolidBlocks made by GameWorld.add_tilemap
+        self.blocks = []
+
+    @classmethod
+    def from_text(cls, text, tile_size=16, solid="#", x=0, y=0):
+        rows = text.splitlines()
+        width = max((len(row) for row in rows), default=0)
+        tiles = bytearray()
+        for row in rows:
+            tiles.extend(1 if char in solid else 0 for char in row.ljust(width))
+        return cls(width, len(rows), tile_size, x, y, tiles)
+
+    def cell(self, x, y):
+        # the tile at pixel (x, y), 0 outside the map
+        column, row = (x - self.x) // self.tile_size, (y - self.y) // self.tile_size
+        if 0 <= column < self.width and 0 <= row < self.height:
+            return self.tiles[row*self.width + column]
+        return 0
+
+    def solid_in(self, rect):
+        # whether any solid tile overlaps rect
+        size = self.tile_size
+        left = max(0, (rect.left - self.x) // size)
+        right = min(self.width, (rect.right - 1 - self.x) // size + 1)
+        top = max(0, (rect.top - self.y) // size)
+        bottom = min(self.height, (rect.bottom - 1 - self.y) // size + 1)
+        if left >= right:
+            return False
+        tiles = self.tiles
+        for row in range(top, bottom):
+            start = row*self.width
+            if tiles[start + left:start + right].count(0) != right - left:
+                return True
+        return False
+
+    def colliders(self):
+        # greedy merging: every run of solid tiles in a row grows down while the rows below
+        # are solid over the same columns; merged tiles are cleared from the working copy
+        width, height, size = self.width, self.height, self.tile_size
+        solid = bytearray(1 if tile else 0 for tile in self.tiles)
+        rects = []
+        for row in range(height):
+            start = row*width
+            column = 0
+            while column < width:
+                if not solid[start + column]:
+                    column += 1
+                    continue
+                end = column
+                while end < width and solid[start + end]:
+                    end += 1
+                bottom = row + 1
+                while bottom < height and solid.find(0, bottom*width + column, bottom*width + end) == -1:
+                    bottom += 1
+                empty = bytes(end - column)
+                for merged in range(row, bottom):
+                    solid[merged*width + column:merged*width + end] = empty
+                rects.append(Rect(self.x + column*size, self.y + row*size, (end - column)*size, (bottom - row)*size))
+                column = end
+        return rects
+
+
+class KinematicPlatforms:
+
+    # owns the MovingBlocks and advances all of them in one pass per tick
+
+    def __init__(self, grid, sleeping, wake):
+        self.grid = grid
+        self.blocks = []
+        # sleeping entities, wake(area) wakes the ones a block comes close to
+        self.sleeping = sleeping
+        self.wake = wake
+
+    def add(self, block):
+        self.blocks.append(block)
+
+    def remove(self, block):
+        self.blocks.remove(block)
+
+    def on_tick(self, event):
+        left, right = MovingBlock.DirectionState.left, MovingBlock.DirectionState.right
+        move = self.grid.move
+        for block in self.blocks:
+            rect = block.rect
+            if block.direction is left:
+                if rect.x < block.initial_x - block.distance:
+                    block.direction = right
+            elif rect.x > block.initial_x + block.distance:
+                block.direction = left
+            velocity = block.direction.value*block.speed
+            block.velocity.x = velocity
+            rect.x += velocity
+            move(block)
+            if self.sleeping:
+                self.wake(rect.inflate(2*block.speed + 2, 2))
+
+
 class GameWorld:
 
-    def __init__(self):
+    def __init__(self, cell_size=128):
         self.blocks = [[] for _ in range(5)]
         self.entities = [[] for _ in range(5)]
         self.gui_items = [[] for _ in range(5)]
+        self.block_grid = SpatialHash(cell_size)
+        self.entity_grid = SpatialHash(cell_size)
+        # blocks and entities in the cells around the camera view, all that render() looks at
+        self.visible_blocks = VisibleSet(self.block_grid)
+        self.visible_entities = VisibleSet(self.entity_grid)
+        # entities skipped by physic() until woken
+        self.sleeping = set()
+        self.platforms = KinematicPlatforms(self.block_grid, self.sleeping, self.wake_entities)
+        self.moving_blocks = self.platforms.blocks
+        # bumped whenever a static block is added or removed
+        self.static_version = 0
+        # EntityStores of the StoredEntities added to the world
+        self.entity_stores = []
+        # ParticleSystems, stepped with the physics and drawn in their layer
+        self.particle_systems = []
+        # TileMaps, their solid tiles collide as merged SolidBlocks
+        self.tilemaps = []
+        # static blocks baked into chunk surfaces, None until bake_static()
+        self.static_chunks = None
+        # every GUI layer is drawn from one cached surface, rebuilt when a widget invalidates it
+        self.gui_surfaces = [None] * 5
+        self.stale_gui = set(range(5))
+        # widget rects for click routing
+        self.gui_grid = SpatialHash(64)
+        # LevelStreamer of a level loaded with stream()
+        self.streamer = None
+        # Profiler timing every layer of render(), None when layers are not profiled
+        self.profiler = None
 
     def add_block(self, obj):
         self.blocks[obj.layer].append(obj)
+        self.block_grid.insert(obj)
+        self.wake_entities(obj.rect.inflate(2, 2))
+        if obj.moving:
+            self.platforms.add(obj)
+        else:
+            self.static_version += 1
+            if self.static_chunks is not None:
+                self.static_chunks.add(obj)
 
     def remove_block(self, obj):
         self.blocks[obj.layer].remove(obj)
+        self.block_grid.remove(obj)
+        self.wake_entities(obj.rect.inflate(2, 2))
+        if obj.moving:
+            self.platforms.remove(obj)
+        else:
+            self.static_version += 1
+            if self.static_chunks is not None:
+                self.static_chunks.remove(obj)
+
+    def add_tilemap(self, tilemap):
+        self.tilemaps.append(tilemap)
+        for rect in tilemap.colliders():
+            block = SolidBlock(*rect)
+            tilemap.blocks.append(block)
+            self.add_block(block)
+
+    def remove_tilemap(self, tilemap):
+        self.tilemaps.remove(tilemap)
+        for block in tilemap.blocks:
+            self.remove_block(block)
+        tilemap.blocks.clear()
+
+    def on_tiles(self, rect):
+        # cell lookups instead of a block query, for rects next to tiles
+        for tilemap in self.tilemaps:
+            if tilemap.solid_in(rect):
+                return True
+        return False
+
+    def bake_static(self, chunk_size=512):
+        self.static_chunks = StaticChunks(chunk_size)
+        for layer in range(5):
+            for block in self.blocks[layer]:
+                if not block.moving:
+                    self.static_chunks.add(block)
+
+    def refresh_block(self, obj):
+        # a static block changed its image or visibility, its chunks need baking again
+        if self.static_chunks is not None and not obj.moving and obj in self.block_grid.keys:
+            self.static_chunks.remove(obj)
+            self.static_chunks.add(obj)
+
+    def move_block(self, obj):
+        self.block_grid.move(obj)
+        self.wake_entities(obj.rect.inflate(2, 2))
+
+    def colliding_blocks(self, rect, area):
+        # blocks colliding with rect, in the same order as a scan over all layers;
+        # the caller may move rect between steps, area is the region rect swept through
+        area = Rect(area)
+        candidates = self.block_grid.query(area)
+        index = 0
+        while index < len(candidates):
+            block = candidates[index]
+            index += 1
+            if rect.colliderect(block.rect):
+                yield block
+                if not area.contains(rect):
+                    # resolution pushed rect out of the queried cells
+                    area.union_ip(rect)
+                    order = self.block_grid.order[block]
+                    candidates = [other for other in self.block_grid.query(area)
+                                  if self.block_grid.order[other] > order]
+                    index = 0
+
+    def sweep(self, rect, dx, dy):
+        # shortens an axis aligned move of rect that would pass through a block: it stops one
+        # pixel inside the first block on the way, so the usual overlap resolution snaps it to the contact
+        if not dx and not dy:
+            return dx, dy
+        for block in self.block_grid.query(rect.union(rect.move(dx, dy))):
+            other = block.rect
+            if dx and rect.top < other.bottom and other.top < rect.bottom:
+                if dx > 0 and other.left >= rect.right:
+                    dx = min(dx, other.left - rect.right + 1)
+                elif dx < 0 and other.right <= rect.left:
+                    dx = max(dx, other.right - rect.left - 1)
+            elif dy and rect.left < other.right and other.left < rect.right:
+                if dy > 0 and other.top >= rect.bottom:
+                    dy = min(dy, other.top - rect.bottom + 1)
+                elif dy < 0 and other.bottom <= rect.top:
+                    dy = max(dy, other.bottom - rect.top - 1)
+        return dx, dy
 
     def add_entity(self, obj):
+        if isinstance(obj, StoredEntity):
+            # simulated and drawn by its store
+            if obj.store not in self.entity_stores:
+                self.entity_stores.append(obj.store)
+            return
         self.entities[obj.layer].append(obj)
+        self.entity_grid.insert(obj)
 
     def remove_entity(self, obj):
+        if isinstance(obj, StoredEntity):
+            obj.store.remove(obj)
+            return
         self.entities[obj.layer].remove(obj)
+        self.entity_grid.remove(obj)
+        self.sleeping.discard(obj)
+
+    def move_entity(self, obj):
+        self.entity_grid.move(obj)
+
+    def wake_entities(self, area):
+        # wakes the sleeping entities in area, e.g. next to a block that was added or moved
+        if self.sleeping:
+            for entity in self.entity_grid.query(area):
+                if entity.asleep:
+                    entity.wake()
 
     def add_gui(self, obj):
         self.gui_items[obj.layer].append(obj)
+        self.gui_grid.insert(obj)
+        self.stale_gui.add(obj.layer)
 
     def remove_gui(self, obj):
         self.gui_items[obj.layer].remove(obj)
+        self.gui_grid.remove(obj)
+        self.stale_gui.add(obj.layer)
+
+    def invalidate_gui(self, obj):
+        self.stale_gui.add(obj.layer)
+
+    def compose_gui(self, layer):
+        items = [item for item in self.gui_items[layer] if item.visible]
+        if not items:
+            self.gui_surfaces[layer] = None
+            return
+        area = items[0].screen_rect().unionall([item.screen_rect() for item in items[1:]])
+        surface = pygame.Surface(area.size, SRCALPHA)
+        for item in items:
+            item.draw(surface, area.topleft)
+        # run-length encoding makes the transparent gaps between widgets almost free to blit
+        if not game.headless:
+            surface = surface.convert_alpha()
+        surface.set_alpha(255, RLEACCEL)
+        self.gui_surfaces[layer] = (surface, area.topleft)
+
+    def on_click(self, event):
+        # only the widgets under the cursor are asked
+        for item in self.gui_grid.query(Rect(event.mouse_x, event.mouse_y, 1, 1)):
+            if item.visible:
+                item.on_click(event)
+
+    def stream(self, path, margin=256):
+        # blocks come from the level file around the camera instead of being added up front
+        level = LevelFile(path)
+        camera.set_level_area(level.level_width, level.level_height)
+        self.streamer = LevelStreamer(self, level, margin)
+        return level
+
+    def update_streaming(self, view, wait=False):
+        if self.streamer is not None:
+            self.streamer.update(view, wait)
 
-    def render(self):
+    def physic(self):
+        move = self.entity_grid.move
+        for layer in range(5):
+            for entity in self.entities[layer]:
+                if entity.asleep:
+                    continue
+                entity.physic()
+                move(entity)
+                if entity.asleep:
+                    self.sleeping.add(entity)
+        for store in self.entity_stores:
+            store.step(self)
+        for system in self.particle_systems:
+            system.step()
+
+    def add_particles(self, system):
+        self.particle_systems.append(system)
+
+    def remove_particles(self, system):
+        self.particle_systems.remove(system)
+
+    def save_positions(self):
+        for block in self.moving_blocks:
+            block.previous_rect = block.rect.copy()
         for layer in range(5):
-            for game_object in self.blocks[layer]:
-                if game_object.visible:
-                    game_object.render()
-            for game_entity in self.entities[layer]:
+            for entity in self.entities[layer]:
+                entity.previous_rect = entity.rect.copy()
+        for store in self.entity_stores:
+            store.save_positions()
+
+    def update_visible(self):
+        self.visible_blocks.update(camera.state)
+        self.visible_entities.update(camera.state)
+
+    def renderables(self, alpha=1.0):
+        self.update_visible()
+        blocks, entities = self.visible_blocks.layers(), self.visible_entities.layers()
+        for layer in range(5):
+            yield from blocks[layer]
+            yield from entities[layer]
+            for store in self.entity_stores:
+                if store.layer == layer:
+                    stored = store.entities
+                    yield from (stored[row] for row in store.in_view(camera.state, alpha).tolist())
+            yield from self.gui_items[layer]
+
+    def render(self, alpha=1.0, surface=None):
+        # draws to surface, the screen by default
+        target = surface or game.screen
+        profiler = self.profiler
+        # only the blocks and entities around the view are looked at
+        self.update_visible()
+        blocks, entities = self.visible_blocks.layers(), self.visible_entities.layers()
+        for layer in range(5):
+            if profiler is not None:
+                start = time.perf_counter()
+            if self.static_chunks is None:
+                for game_object in blocks[layer]:
+                    if game_object.visible:
+                        game_object.render(alpha, target)
+            else:
+                self.static_chunks.render(layer, target)
+                for game_object in blocks[layer]:
+                    if game_object.moving and game_object.visible:
+                        game_object.render(alpha, target)
+            for game_entity in entities[layer]:
                 if game_entity.visible:
-                    game_entity.render()
-            for gui_item in self.gui_items[layer]:
-                if gui_item.visible:
-                    gui_item.render()
+                    game_entity.render(alpha, target)
+            for store in self.entity_stores:
+                if store.layer == layer:
+                    store.render(alpha, target)
+            for system in self.particle_systems:
+                if system.layer == layer:
+                    system.render(alpha, target)
+            if layer in self.stale_gui:
+                self.compose_gui(layer)
+                self.stale_gui.discard(layer)
+            if self.gui_surfaces[layer] is not None:
+                image, position = self.gui_surfaces[layer]
+                target.blit(image, position)
+            if profiler is not None:
+                profiler.add(profiler.layer_names[layer], time.perf_counter() - start)
 
 
 world = GameWorld()
 
 
-class EventBase:
+def merge_rects(rects):
+    # unions overlapping rects until none overlap
+    merged = []
+    for rect in rects:
+        rect = Rect(rect)
+        index = rect.collidelist(merged)
+        while index != -1:
+            rect.union_ip(merged.pop(index))
+            index = rect.collidelist(merged)
+        merged.append(rect)
+    return merged
 
-    def __init__(self, name):
-        self.name = name
-        self.listeners = []
 
-    def __call__(self, *args, **kwargs):
-        return self
+class DirtyRectRenderer:
 
-    def notify_listeners(self):
-        for listener in self.listeners:
-            listener.notify(self)
+    def __init__(self, world, camera, background=pygame.Color("black"), scroll_limit=64, full_ratio=0.5):
+        self.world = world
+        self.camera = camera
+        self.background = background
+        # camera moves further than scroll_limit, or dirty areas larger than full_ratio
+        # of the screen, repaint the whole screen instead
+        self.scroll_limit = scroll_limit
+        self.full_ratio = full_ratio
+        self.previous = dict()
+        self.previous_camera = None
+        # the world's blits of a frame, recorded once and replayed into each dirty rect
+        self.snapshot = Snapshot()
+
+    def render(self, alpha=1.0):
+        # draws the world and returns the screen rects which need updating
+        screen = game.screen
+        current = dict()
+        for game_object in self.world.renderables(alpha):
+            if game_object.visible:
+                rect = game_object.screen_rect(alpha)
+                if rect is not None:
+                    current[game_object] = rect
+        # particles aren't tracked one by one, while there are any the whole screen is repainted
+        full = (self.previous_camera is None or
+                abs(self.camera.state.x - self.previous_camera.x) > self.scroll_limit or
+                abs(self.camera.state.y - self.previous_camera.y) > self.scroll_limit or
+                any(system.count for system in self.world.particle_systems))
+        dirty = []
+        if not full:
+            for game_object, rect in current.items():
+                old = self.previous.get(game_object)
+                if old != rect or game_object.dirty:
+                    dirty.append(rect)
+                    if old is not None:
+                        dirty.append(old)
+            for game_object, old in self.previous.items():
+                if game_object not in current:
+                    dirty.append(old)
+            screen_rect = screen.get_rect()
+            dirty = [rect.clip(screen_rect) for rect in merge_rects(dirty)]
+            dirty = [rect for rect in dirty if rect.width and rect.height]
+            full = sum(rect.width*rect.height for rect in dirty) > self.full_ratio*screen_rect.width*screen_rect.height
+        for game_object in current:
+            game_object.dirty = False
+        self.previous = current
+        self.previous_camera = self.camera.state.copy()
+        if full:
+            screen.fill(self.background)
+            self.world.render(alpha)
+            return [screen.get_rect()]
+        commands = self.snapshot.commands
+        commands.clear()
+        self.world.render(alpha, self.snapshot)
+        areas = [Rect(command[1], command[2].size if command[2] is not None else command[0].get_size())
+                 for command in commands]
+        for rect in dirty:
+            screen.set_clip(rect)
+            screen.fill(self.background, rect)
+            screen.blits([commands[index] for index in rect.collidelistall(areas)], doreturn=False)
+        screen.set_clip(None)
+        return dirty
+
+
+class Snapshot:
+
+    # what one tick looks like on screen: the blits world.render() made, recorded instead of drawn;
+    # the surfaces are never changed once drawn, new looks get new surfaces
 
-    def register(self, listener):
-        self.listeners.append(listener)
+    def __init__(self):
+        self.commands = []
+        self.tick = 0
+        self.published = 0.0
 
-    def unregister(self, listener):
-        self.listeners.remove(listener)
+    def blit(self, source, dest, area=None, special_flags=0):
+        if special_flags:
+            self.commands.append((source, tuple(dest)[:2], area, special_flags))
+        else:
+            self.commands.append((source, tuple(dest)[:2], area))
 
+    def blits(self, sequence, doreturn=True):
+        for blit in sequence:
+            self.blit(*blit)
 
-class TickEvent(EventBase):
+    def capture(self, world, tick):
+        self.commands.clear()
+        world.render(1.0, self)
+        self.tick = tick
+        self.published = time.perf_counter()
 
-    def __init__(self):
-        super().__init__("tick")
+    def draw(self, surface):
+        surface.blits(self.commands, doreturn=False)
 
 
-class LMBClickEvent(EventBase):
+class SnapshotBuffer:
+
+    # two snapshots, the simulation writes the one the renderer isn't reading;
+    # a snapshot the renderer hasn't picked up yet is simply overwritten by a newer one
 
     def __init__(self):
-        super().__init__("lmb_click")
-        self.mouse_x = 0
-        self.mouse_y = 0
+        self.slots = (Snapshot(), Snapshot())
+        self.latest = None
+        self.reading = None
+        self.dropped = 0
+        self.condition = threading.Condition()
+
+    def begin_write(self):
+        with self.condition:
+            index = 1 if self.reading == 0 or (self.reading is None and self.latest == 0) else 0
+            if index == self.latest:
+                self.latest = None
+                self.dropped += 1
+            return index, self.slots[index]
+
+    def publish(self, index):
+        with self.condition:
+            if self.latest is not None:
+                self.dropped += 1
+            self.latest = index
+            self.condition.notify()
+
+    def acquire(self, timeout):
+        # the newest snapshot not drawn yet, None when none came within timeout
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.latest is not None, timeout):
+                return None
+            self.reading, self.latest = self.latest, None
+            return self.slots[self.reading]
+
+    def release(self):
+        with self.condition:
+            self.reading = None
+
+
+class Pipeline:
+
+    # simulation on a worker thread at sim_hz, the main thread only polls input and draws the
+    # latest snapshot, so blitting and flipping overlap with the next tick; a snapshot is at most
+    # one tick plus one frame old when it reaches the screen, ages() measures it
+
+    def __init__(self, engine, sim_hz=60, window=300):
+        self.engine = engine
+        self.step = 1.0 / sim_hz
+        self.buffer = SnapshotBuffer()
+        self.input = queue.Queue()
+        self.running = False
+        self.error = None
+        # seconds from publishing a snapshot to the end of its display update
+        self.recent_ages = array("d", bytes(8*window))
+        self.frames = 0
+        self.thread = threading.Thread(target=self.simulate, daemon=True)
+
+    def simulate(self):
+        engine = self.engine
+        next_time = time.perf_counter()
+        try:
+            while self.running:
+                while True:
+                    try:
+                        EventManager.process_pygame(self.input.get_nowait())
+                    except queue.Empty:
+                        break
+                engine.begin_frame()
+                engine.tick()
+                index, snapshot = self.buffer.begin_write()
+                snapshot.capture(engine.world, engine.ticks)
+                self.buffer.publish(index)
+                engine.lap("snapshot")
+                engine.end_frame()
+                next_time += self.step
+                delay = next_time - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                elif delay < -self.step:
+                    # too far behind, don't try to catch up
+                    next_time = time.perf_counter()
+        except BaseException as error:
+            self.error = error
+            self.running = False
 
-    def __call__(self, *args, **kwargs):
-        self.mouse_x = args[0]
-        self.mouse_y = args[1]
-        return self
+    def run(self):
+        self.running = True
+        self.thread.start()
+        try:
+            while self.running and self.engine.is_running:
+                for event in pygame.event.get():
+                    if event.type == pygame.QUIT:
+                        self.stop()
+                        EventManager.process_pygame(event)
+                    self.input.put(event)
+                snapshot = self.buffer.acquire(self.step)
+                if snapshot is not None:
+                    game.screen.fill(pygame.Color("black"))
+                    snapshot.draw(game.screen)
+                    pygame.display.update()
+                    self.recent_ages[self.frames % len(self.recent_ages)] = time.perf_counter() - snapshot.published
+                    self.frames += 1
+                    self.buffer.release()
+                game.fps_clock.tick(game.fps)
+        finally:
+            self.stop()
+        if self.error is not None:
+            raise self.error
+
+    def stop(self):
+        self.running = False
+        if self.thread.is_alive() and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def ages(self):
+        # snapshot ages of the recent frames, in seconds
+        return self.recent_ages[:min(self.frames, len(self.recent_ages))]
+
+
+class Event:
+
+    # payloads are pooled by EventManager and filled in by reset()
+    __slots__ = ()
+
+    def reset(self):
+        pass
 
 
-class RandomNumberEvent(EventBase):
+class TickEvent(Event):
 
-    def __init__(self):
-        super().__init__("random_number")
-        self.number = random.randint(0, 99)
+    __slots__ = ()
 
-    def __call__(self, *args, **kwargs):
-        self.number = random.randint(0, 99)
-        return self
 
+class LMBClickEvent(Event):
 
-class KeyboardEvent(EventBase):
+    __slots__ = ("mouse_x", "mouse_y")
 
-    def __init__(self):
-        super().__init__("keyboard")
-        self.keyboard_dict = dict()
+    def reset(self, mouse_x, mouse_y):
+        self.mouse_x = mouse_x
+        self.mouse_y = mouse_y
 
-    def __call__(self):
-        return self
 
-    def add_key(self, state, char_ord):
-        self.keyboard_dict[char_ord] = state
+class RandomNumberEvent(Event):
 
+    __slots__ = ("number",)
 
-class CollisionEvent(EventBase):
+    def reset(self):
+        self.number = random.randint(0, 99)
 
-    def __init__(self):
-        super().__init__("collision")
-        self.objects = ()
 
-    def __call__(self, *args, **kwargs):
-        self.objects = args
-        return self
+class KeyboardEvent(Event):
 
+    __slots__ = ("keyboard_dict",)
 
-class LabelClickedEvent(EventBase):
+    def reset(self, keyboard_dict):
+        self.keyboard_dict = keyboard_dict
 
-    def __init__(self):
-        super().__init__("label_clicked")
-        self.label = None
 
-    def __call__(self, *args, **kwargs):
-        self.label = args[0]
-        return self
+class LabelClickedEvent(Event):
+
+    __slots__ = ("label",)
+
+    def reset(self, label):
+        self.label = label
 
 
-TickEvent = TickEvent()
-LMBClickEvent = LMBClickEvent()
-RandomNumberEvent = RandomNumberEvent()
-KeyboardEvent = KeyboardEvent()
-CollisionEvent = CollisionEvent()
-LabelClickedEvent = LabelClickedEvent()
+class LandedEvent(Event):
+
+    # an entity came down on a block at (x, y) falling at speed
+    __slots__ = ("entity", "x", "y", "speed")
+
+    def reset(self, entity, x, y, speed):
+        self.entity = entity
+        self.x = x
+        self.y = y
+        self.speed = speed
 
 
 class EventManager:
@@ -700,85 +2595,502 @@ class EventManager:
     def __init__(self):
         self.event_queue = []
         self.event_stack = []
+        # event type -> callbacks in dispatch order, types nobody listens to are absent
+        self.handlers = dict()
+        self.subscriptions = dict()
+        self.subscription_count = 0
+        self.pools = dict()
+        # pressed (True) and released (False) keys, keys never touched are missing
+        self.keyboard_dict = dict()
+        # Profiler timing every callback, None when listeners are not profiled
+        self.profiler = None
+        # InputRecorder logging the input, InputReplay feeding logged input back in
+        self.recorder = None
+        self.replay = None
+
+    def subscribe(self, event_type, callback, priority=0):
+        # higher priorities run first, equal priorities in subscription order
+        self.subscription_count += 1
+        subscriptions = self.subscriptions.setdefault(event_type, [])
+        subscriptions.append((-priority, self.subscription_count, callback))
+        subscriptions.sort(key=lambda subscription: subscription[:2])
+        self.handlers[event_type] = tuple(subscription[2] for subscription in subscriptions)
+
+    def unsubscribe(self, event_type, callback):
+        subscriptions = [subscription for subscription in self.subscriptions.get(event_type, ())
+                         if subscription[2] != callback]
+        if subscriptions:
+            self.subscriptions[event_type] = subscriptions
+            self.handlers[event_type] = tuple(subscription[2] for subscription in subscriptions)
+        else:
+            self.subscriptions.pop(event_type, None)
+            self.handlers.pop(event_type, None)
+
+    def acquire(self, event_type, *args):
+        pool = self.pools.get(event_type)
+        event = pool.pop() if pool else event_type()
+        event.reset(*args)
+        return event
+
+    def release(self, event):
+        self.pools.setdefault(type(event), []).append(event)
+
+    def post(self, event_type, *args):
+        # queues an event for this frame, dropped when nobody listens
+        if event_type in self.handlers:
+            self.event_queue.append(self.acquire(event_type, *args))
+
+    def generate_event(self, event_type, *args):
+        # queues an event for the next frame, dropped when nobody listens
+        if event_type in self.handlers:
+            self.event_stack.append(self.acquire(event_type, *args))
+
+    def add_key(self, state, char_ord):
+        self.keyboard_dict[char_ord] = state
+        if self.recorder is not None:
+            self.recorder.key(state, char_ord)
+
+    def click(self, mouse_x, mouse_y):
+        self.post(LMBClickEvent, mouse_x, mouse_y)
+        if self.recorder is not None:
+            self.recorder.click(mouse_x, mouse_y)
 
     def process_normal(self):
-        self.event_queue.append(TickEvent())
-        self.event_queue.append(RandomNumberEvent())
-        self.event_queue.append(KeyboardEvent())
+        self.post(TickEvent)
+        self.post(RandomNumberEvent)
+        self.post(KeyboardEvent, self.keyboard_dict)
         self.event_queue.extend(self.event_stack)
         self.event_stack.clear()
 
-    def generate_event(self, event):
-        self.event_stack.append(event)
-
     def process_pygame(self, event):
         if event.type == pygame.QUIT:
             pygame.quit()
             sys.exit()
         elif event.type == pygame.KEYDOWN:
-            KeyboardEvent.add_key(True, event.key)
+            self.add_key(True, event.key)
         elif event.type == pygame.KEYUP:
-            KeyboardEvent.add_key(False, event.key)
+            self.add_key(False, event.key)
         elif event.type == pygame.MOUSEBUTTONDOWN:
-            self.event_queue.append(LMBClickEvent(*event.pos))
+            self.click(*event.pos)
 
     def process(self):
+        # process runs once per tick, input given before it belongs to this tick
+        if self.replay is not None:
+            self.replay.apply(self)
+        if self.recorder is not None:
+            self.recorder.end_tick()
+        if self.profiler is not None:
+            self.process_profiled()
+            return
+        handlers = self.handlers
         for event in self.event_queue:
-            event.notify_listeners()
+            for callback in handlers.get(type(event), ()):
+                callback(event)
+            self.release(event)
+        self.event_queue.clear()
+
+    def process_profiled(self):
+        handlers = self.handlers
+        add = self.profiler.add
+        clock = time.perf_counter
+        for event in self.event_queue:
+            for callback in handlers.get(type(event), ()):
+                start = clock()
+                callback(event)
+                add("notify %s" % callback.__qualname__, clock() - start)
+            self.release(event)
         self.event_queue.clear()
 
 
 EventManager = EventManager()
 
 
+def subscribe_world():
+    EventManager.subscribe(LMBClickEvent, world.on_click)
+    EventManager.subscribe(TickEvent, world.platforms.on_tick)
+
+
+subscribe_world()
+
+
+def reset():
+    # fresh log, camera, world and events, so one process can run session after session
+    global log, camera, world, EventManager
+    if world.streamer is not None:
+        world.streamer.close()
+    log = Log()
+    camera = GameCamera(game.window_width, game.window_height)
+    camera.set_level_area(2000, 1000)
+    world = GameWorld()
+    EventManager = type(EventManager)()
+    subscribe_world()
+
+
+class InputLog:
+
+    # header: magic, version, random seed, kind of level (built in, level file, tile map),
+    # length of the level path, then the path;
+    # then for every tick with input: ticks since the previous one, number of changes
+    # and the changes, all as unsigned varints; a change is kind (released, pressed, click)
+    # followed by the key code or the mouse position
+    magic = b"PINP"
+    version = 2
+    header = struct.Struct("<4sHQBH")
+    key_released, key_pressed, mouse_click = range(3)
+    level_built_in, level_file, level_tiles = range(3)
+
+    @staticmethod
+    def write_varint(out, value):
+        while value > 0x7f:
+            out.append(value & 0x7f | 0x80)
+            value >>= 7
+        out.append(value)
+
+    @staticmethod
+    def read_varint(data, offset):
+        value = shift = 0
+        while True:
+            byte = data[offset]
+            offset += 1
+            value |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return value, offset
+            shift += 7
+
+
+class InputRecorder(InputLog):
+
+    def __init__(self, path, seed, level_kind=InputLog.level_built_in, level=None):
+        self.file = open(path, "wb")
+        level = (level or "").encode()
+        self.file.write(self.header.pack(self.magic, self.version, seed, level_kind, len(level)) + level)
+        self.tick = 0
+        self.last_tick = 0
+        self.changes = []
+
+    def key(self, state, key):
+        self.changes.append((self.key_pressed if state else self.key_released, key))
+
+    def click(self, mouse_x, mouse_y):
+        self.changes.append((self.mouse_click, mouse_x, mouse_y))
+
+    def end_tick(self):
+        if self.changes:
+            self.write_tick(self.changes)
+            self.changes = []
+        self.tick += 1
+
+    def write_tick(self, changes):
+        out = bytearray()
+        self.write_varint(out, self.tick - self.last_tick)
+        self.write_varint(out, len(changes))
+        for change in changes:
+            for value in change:
+                self.write_varint(out, value)
+        self.file.write(out)
+        self.last_tick = self.tick
+
+    def close(self):
+        # an empty last tick, so the replay knows how long the session went on;
+        # input which never reached a tick is dropped
+        self.tick = max(self.tick - 1, self.last_tick)
+        self.write_tick([])
+        self.file.close()
+
+
+class InputReplay(InputLog):
+
+    def __init__(self, path):
+        with open(path, "rb") as file:
+            self.data = file.read()
+        magic, version, self.seed, self.level_kind, length = self.header.unpack_from(self.data)
+        if magic != self.magic or version != self.version:
+            raise ValueError("%s is not an input log" % path)
+        offset = self.header.size
+        self.level = self.data[offset:offset + length].decode() or None
+        self.offset = offset + length
+        self.tick = 0
+        self.next_tick = None
+        self.read_next_tick()
+
+    def read_next_tick(self):
+        if self.offset >= len(self.data):
+            self.next_tick = None
+            return
+        delta, self.offset = self.read_varint(self.data, self.offset)
+        self.next_tick = delta if self.next_tick is None else self.next_tick + delta
+
+    @property
+    def finished(self):
+        return self.next_tick is None
+
+    def apply(self, events):
+        while self.next_tick == self.tick:
+            count, offset = self.read_varint(self.data, self.offset)
+            for _ in range(count):
+                kind, offset = self.read_varint(self.data, offset)
+                if kind == self.mouse_click:
+                    mouse_x, offset = self.read_varint(self.data, offset)
+                    mouse_y, offset = self.read_varint(self.data, offset)
+                    events.click(mouse_x, mouse_y)
+                else:
+                    key, offset = self.read_varint(self.data, offset)
+                    events.add_key(kind == self.key_pressed, key)
+            self.offset = offset
+            self.read_next_tick()
+        self.tick += 1
+
+
 class Engine:
 
-    def __init__(self):
+    def __init__(self, headless=False, fixed_step=False, sim_hz=60, max_steps=5, dirty_rects=False,
+                 chunk_size=512, profiler=None, pipelined=False):
         self.is_running = True
         self.world = world
+        # headless engines never open a window, render or throttle
+        self.headless = headless
+        if not headless:
+            game.open_window()
+            assets.convert()
+            # static level geometry is drawn from pre-baked chunks, 0 draws every block
+            if chunk_size:
+                self.world.bake_static(chunk_size)
+        self.ticks = 0
         self.player = Player(50, 50, 40, 40)
         self.world.add_entity(self.player)
         self.camera = camera
+        if self.world.streamer is not None:
+            # the first view has to be there before the player starts falling
+            self.camera.update(self.player)
+            self.world.update_streaming(self.camera.state, wait=True)
         log.add_object(self.player)
         self.log = log
+        # fixed timestep: simulation runs at sim_hz whatever the frame rate,
+        # catching up at most max_steps ticks per rendered frame
+        self.fixed_step = fixed_step
+        self.sim_hz = sim_hz
+        self.max_steps = max_steps
+        # dirty rect renderer repaints and updates only what changed on screen
+        self.renderer = DirtyRectRenderer(world, camera) if dirty_rects else None
+        # Profiler timing the phases of every frame, None runs without instrumentation
+        self.profiler = profiler
+        # simulation on its own thread, rendering snapshots of it; False runs everything in turn
+        self.pipeline = Pipeline(self, sim_hz) if pipelined and not headless else None
+        if profiler is not None:
+            if profiler.listeners:
+                EventManager.profiler = profiler
+            if profiler.layers:
+                self.world.profiler = profiler
+
+    def lap(self, phase):
+        if self.profiler is not None:
+            self.profiler.lap(phase)
+
+    def begin_frame(self):
+        if self.profiler is not None:
+            self.profiler.begin()
+
+    def end_frame(self):
+        if self.profiler is not None:
+            self.profiler.end()
+
+    def handle_input(self):
+        for event in pygame.event.get():
+            EventManager.process_pygame(event)
+
+    def tick(self):
+        EventManager.process_normal()
+        self.simulate()
+
+    def simulate(self):
+        # the rest of a tick once its events are queued
+        EventManager.process()
+        self.lap("events")
+        self.world.physic()
+        self.lap("physics")
+        self.camera.update(self.player)
+        self.world.update_streaming(self.camera.state)
+        self.lap("camera")
+        self.log.record()
+        self.lap("log")
+        self.ticks += 1
+
+    def step(self, n=1):
+        for _ in range(n):
+            self.begin_frame()
+            self.tick()
+            self.end_frame()
+        return self.ticks
+
+    def render(self, alpha=1.0):
+        if self.renderer is None:
+            game.screen.fill(pygame.Color("black"))
+            self.world.render(alpha)
+            self.lap("render")
+            pygame.display.update()
+        else:
+            dirty = self.renderer.render(alpha)
+            self.lap("render")
+            pygame.display.update(dirty)
+        self.lap("display")
 
     def run(self):
+        if self.headless:
+            while self.is_running:
+                self.begin_frame()
+                self.tick()
+                self.end_frame()
+            return
+        if self.pipeline is not None:
+            self.pipeline.run()
+            return
+        if self.fixed_step:
+            self.run_fixed()
+            return
         while self.is_running:
-            game.screen.fill(pygame.Color("black"))
+            self.begin_frame()
             EventManager.process_normal()
-            for event in pygame.event.get():
-                EventManager.process_pygame(event)
-            EventManager.process()
-            self.player.physic()
-            self.camera.update(self.player)
-            self.world.render()
-            pygame.display.update()
+            self.handle_input()
+            self.simulate()
+            self.render()
             game.fps_clock.tick(game.fps)
+            self.lap("wait")
+            self.end_frame()
 
-
-#########
-#########
-# borders
-world.add_block(SolidBlock(0, 0, 2000, 20))
-world.add_block(SolidBlock(0, 0, 20, 1000))
-world.add_block(SolidBlock(0, 980, 2000, 20))
-world.add_block(SolidBlock(1980, 0, 20, 1000))
-# platforms
-world.add_block(SolidBlock(1000, 700, 600, 40))
-world.add_block(SolidBlock(400, 200, 500, 40))
-world.add_block(SolidBlock(1100, 300, 400, 40))
-world.add_block(SolidBlock(1500, 500, 300, 40))
-world.add_block(SolidBlock(400, 500, 300, 40))
-world.add_block(SolidBlock(600, 800, 200, 40))
-world.add_block(SolidBlock(1700, 200, 200, 40))
-# moving platforms
-world.add_block(MovingBlock(1000, 600, 200, 40, 600, 2))
-log.add_object(world.blocks[0][11])
-# health bar
-world.add_gui(HealthBar(50, 50, 100, 30))
-# test label
-world.add_gui(Button(100, 400, 100, 50, 20, "Hello world!", (255, 0, 0, 0), (0, 255, 0, 0), "verdana", 23))
-#########
-#########
-engine = Engine()
-engine.run()
+    def run_fixed(self):
+        step = 1.0 / self.sim_hz
+        accumulator = 0.0
+        previous = time.perf_counter()
+        while self.is_running:
+            self.begin_frame()
+            now = time.perf_counter()
+            accumulator += now - previous
+            previous = now
+            self.handle_input()
+            self.lap("events")
+            steps = 0
+            while accumulator >= step and steps < self.max_steps:
+                self.world.save_positions()
+                self.tick()
+                accumulator -= step
+                steps += 1
+            if accumulator >= step:
+                # too far behind, drop the time instead of spiralling into more catch-up work
+                accumulator %= step
+            alpha = accumulator / step
+            self.camera.update(self.player, alpha)
+            self.lap("camera")
+            self.render(alpha)
+            # game.fps caps the render rate only, 0 renders as fast as possible
+            game.fps_clock.tick(game.fps)
+            self.lap("wait")
+            self.end_frame()
+
+
+def build_level(world):
+    # borders
+    world.add_block(SolidBlock(0, 0, 2000, 20))
+    world.add_block(SolidBlock(0, 0, 20, 1000))
+    world.add_block(SolidBlock(0, 980, 2000, 20))
+    world.add_block(SolidBlock(1980, 0, 20, 1000))
+    # platforms
+    world.add_block(SolidBlock(1000, 700, 600, 40))
+    world.add_block(SolidBlock(400, 200, 500, 40))
+    world.add_block(SolidBlock(1100, 300, 400, 40))
+    world.add_block(SolidBlock(1500, 500, 300, 40))
+    world.add_block(SolidBlock(400, 500, 300, 40))
+    world.add_block(SolidBlock(600, 800, 200, 40))
+    world.add_block(SolidBlock(1700, 200, 200, 40))
+    # moving platforms
+    world.add_block(MovingBlock(1000, 600, 200, 40, 600, 2))
+    log.add_object(world.blocks[0][11])
+    # health bar
+    world.add_gui(HealthBar(50, 50, 100, 30))
+    # test label
+    world.add_gui(Button(100, 400, 100, 50, 20, "Hello world!", (255, 0, 0, 0), (0, 255, 0, 0), "verdana", 23))
+
+
+def load_level(kind, path=None):
+    # kind is one of the InputLog level kinds, path the level or tile map file
+    if kind == InputLog.level_file:
+        world.stream(path)
+    elif kind == InputLog.level_tiles:
+        with open(path) as file:
+            tilemap = TileMap.from_text(file.read())
+        camera.set_level_area(tilemap.width*tilemap.tile_size, tilemap.height*tilemap.tile_size)
+        world.add_tilemap(tilemap)
+    else:
+        build_level(world)
+
+
+def replay_input(path):
+    # runs a recorded session headless as fast as possible, returns the engine and the seconds taken
+    replay = InputReplay(path)
+    random.seed(replay.seed)
+    load_level(replay.level_kind, replay.level)
+    engine = Engine(headless=True)
+    EventManager.replay = replay
+    start = time.perf_counter()
+    while not replay.finished:
+        engine.step()
+    return engine, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--headless", action="store_true", help="simulate without a window")
+    parser.add_argument("--fixed-step", action="store_true", help="simulate at a fixed rate")
+    parser.add_argument("--dirty-rects", action="store_true", help="repaint only changed screen areas")
+    parser.add_argument("--pipelined", action="store_true", help="simulate on a separate thread from rendering")
+    parser.add_argument("--particles", action="store_true", help="a particle trail behind the player and landing dust")
+    parser.add_argument("--tiles", help="play on this text tile map, '#' marks solid tiles")
+    parser.add_argument("--level", help="stream the blocks from this level file")
+    parser.add_argument("--save-level", help="write the built in level to this file and exit")
+    parser.add_argument("--profile", nargs="?", const="", metavar="FILE",
+                        help="time every frame, writing the samples to FILE (.csv or JSON lines) if given")
+    parser.add_argument("--profile-details", action="store_true", help="also time event listeners and render layers")
+    parser.add_argument("--hud", action="store_true", help="show the profiler statistics on screen")
+    parser.add_argument("--seed", type=int, help="seed of the random numbers")
+    parser.add_argument("--record", help="log the input of this session to this file")
+    parser.add_argument("--replay", help="rerun a logged session headless and print where the player ended")
+    args = parser.parse_args()
+    if args.replay:
+        engine, seconds = replay_input(args.replay)
+        print("%d ticks in %.3f s, player at %s, %s" % (engine.ticks, seconds, tuple(engine.player.rect),
+                                                        engine.player.state.name))
+        sys.exit()
+    seed = args.seed if args.seed is not None else random.randrange(2**32)
+    random.seed(seed)
+    if args.save_level:
+        build_level(world)
+        LevelFile.save(args.save_level, [block for layer in world.blocks for block in layer],
+                       camera.level_width, camera.level_height)
+        sys.exit()
+    if args.level:
+        level_kind, level_path = InputLog.level_file, args.level
+    elif args.tiles:
+        level_kind, level_path = InputLog.level_tiles, args.tiles
+    else:
+        level_kind, level_path = InputLog.level_built_in, None
+    load_level(level_kind, level_path)
+    profiler = None
+    if args.profile is not None or args.hud:
+        profiler = Profiler(listeners=args.profile_details, layers=args.profile_details, output=args.profile or None)
+    if args.hud:
+        world.add_gui(PerfHUD(profiler))
+    engine = Engine(headless=args.headless, fixed_step=args.fixed_step, dirty_rects=args.dirty_rects,
+                    profiler=profiler, pipelined=args.pipelined)
+    if args.particles:
+        particles = ParticleSystem()
+        world.add_particles(particles)
+        particles.emit_on_landing()
+        Emitter(particles, engine.player, 2, speed=(0.2, 1), life=(20, 40), color=(90, 160, 255), color_jitter=30)
+    if args.record:
+        EventManager.recorder = InputRecorder(args.record, seed, level_kind, level_path)
+    try:
+        engine.run()
+    finally:
+        if profiler is not None:
+            profiler.close()
+        if EventManager.recorder is not None:
+            EventManager.recorder.close()
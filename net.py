@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import heapq
+import json
+import multiprocessing
+import os
+import random
+import socket
+import struct
+import sys
+import time
+
+# the server runs headless, the dummy driver keeps pygame from looking for a display
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import main
+
+
+# client -> server: type, input sequence, last snapshot tick received, key bits
+INPUT = struct.Struct("<BIIB")
+# server -> client: type, tick, baseline tick, own entity id, last input sequence applied,
+# number of floats of the own player's state; then the state as floats, then the delta
+SNAPSHOT = struct.Struct("<BIIHIB")
+INPUT_PACKET, SNAPSHOT_PACKET = 1, 2
+NO_BASELINE = 0xffffffff
+UP, LEFT, RIGHT = 1, 2, 4
+# snapshot fields of an entity, bits of the field mask
+FIELD_X, FIELD_Y, FIELD_STATE = 1, 2, 4
+
+write_varint = main.InputLog.write_varint
+read_varint = main.InputLog.read_varint
+
+
+def write_signed(out, value):
+    # zigzag, small deltas of either sign take one byte
+    write_varint(out, value*2 if value >= 0 else -value*2 - 1)
+
+
+def read_signed(data, offset):
+    value, offset = read_varint(data, offset)
+    return (value >> 1) ^ -(value & 1), offset
+
+
+class RemotePlayer(main.Player):
+
+    # a Player driven by a key bitmask instead of the local keyboard
+
+    def __init__(self, x, y, width, height):
+        super().__init__(x, y, width, height)
+        self.keys = dict()
+
+    def set_input(self, bits):
+        config = self.key_config
+        for bit, key in ((UP, config.key_up), (LEFT, config.key_left), (RIGHT, config.key_right)):
+            self.keys[key] = bool(bits & bit)
+
+    def on_keyboard(self, event):
+        self.apply_keys(self.keys)
+
+
+class LossyLink:
+
+    # sends through a socket after latency plus up to jitter seconds, dropping loss of the packets;
+    # sent counts the payload bytes handed to send(), lost ones included
+
+    def __init__(self, sock, latency=0.0, jitter=0.0, loss=0.0, seed=0):
+        self.sock = sock
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.rng = random.Random(seed)
+        self.queue = []
+        self.counter = 0
+        self.sent = 0
+
+    def send(self, data, address):
+        self.sent += len(data)
+        if self.rng.random() < self.loss:
+            return
+        self.counter += 1
+        due = time.perf_counter() + self.latency + self.rng.random()*self.jitter
+        heapq.heappush(self.queue, (due, self.counter, data, address))
+        self.flush()
+
+    def flush(self):
+        now = time.perf_counter()
+        while self.queue and self.queue[0][0] <= now:
+            due, counter, data, address = heapq.heappop(self.queue)
+            self.sock.sendto(data, address)
+
+
+def receive_all(sock):
+    packets = []
+    while True:
+        try:
+            packets.append(sock.recvfrom(65536))
+        except BlockingIOError:
+            return packets
+
+
+def encode_snapshot(tick, own_id, last_sequence, own_state, entities, blocks, baseline):
+    # entities maps id to (x, y, state), blocks are the moving block x positions;
+    # baseline is (tick, entities, blocks) of a snapshot the client has, None sends everything
+    if baseline is None:
+        base_tick, base_entities, base_blocks = NO_BASELINE, dict(), [0]*len(blocks)
+    else:
+        base_tick, base_entities, base_blocks = baseline
+    out = bytearray(SNAPSHOT.pack(SNAPSHOT_PACKET, tick, base_tick, own_id, last_sequence, len(own_state)))
+    out += struct.pack("<%df" % len(own_state), *own_state)
+    removed = [entity_id for entity_id in base_entities if entity_id not in entities]
+    write_varint(out, len(removed))
+    for entity_id in removed:
+        write_varint(out, entity_id)
+    changed = []
+    for entity_id, values in entities.items():
+        base = base_entities.get(entity_id)
+        if base is None:
+            changed.append((entity_id, FIELD_X | FIELD_Y | FIELD_STATE, values, (0, 0, 0)))
+        elif base != values:
+            mask = ((FIELD_X if base[0] != values[0] else 0) | (FIELD_Y if base[1] != values[1] else 0) |
+                    (FIELD_STATE if base[2] != values[2] else 0))
+            changed.append((entity_id, mask, values, base))
+    write_varint(out, len(changed))
+    for entity_id, mask, values, base in changed:
+        write_varint(out, entity_id)
+        out.append(mask)
+        if mask & FIELD_X:
+            write_signed(out, values[0] - base[0])
+        if mask & FIELD_Y:
+            write_signed(out, values[1] - base[1])
+        if mask & FIELD_STATE:
+            write_varint(out, values[2])
+    write_varint(out, len(blocks))
+    for x, base in zip(blocks, base_blocks):
+        write_signed(out, x - base)
+    return bytes(out)
+
+
+def decode_snapshot(data, baselines):
+    # (tick, own id, last input sequence, own state, entities, blocks),
+    # None when the baseline it was encoded against is gone
+    kind, tick, base_tick, own_id, last_sequence, floats = SNAPSHOT.unpack_from(data)
+    offset = SNAPSHOT.size
+    own_state = struct.unpack_from("<%df" % floats, data, offset)
+    offset += 4*floats
+    if base_tick == NO_BASELINE:
+        entities, base_blocks = dict(), None
+    elif base_tick in baselines:
+        base_entities, base_blocks = baselines[base_tick]
+        entities = dict(base_entities)
+    else:
+        return None
+    count, offset = read_varint(data, offset)
+    for _ in range(count):
+        entity_id, offset = read_varint(data, offset)
+        entities.pop(entity_id, None)
+    count, offset = read_varint(data, offset)
+    for _ in range(count):
+        entity_id, offset = read_varint(data, offset)
+        mask = data[offset]
+        offset += 1
+        x, y, state = entities.get(entity_id, (0, 0, 0))
+        if mask & FIELD_X:
+            delta, offset = read_signed(data, offset)
+            x += delta
+        if mask & FIELD_Y:
+            delta, offset = read_signed(data, offset)
+            y += delta
+        if mask & FIELD_STATE:
+            state, offset = read_varint(data, offset)
+        entities[entity_id] = (x, y, state)
+    count, offset = read_varint(data, offset)
+    blocks = []
+    for index in range(count):
+        delta, offset = read_signed(data, offset)
+        blocks.append(delta + (base_blocks[index] if base_blocks else 0))
+    return tick, own_id, last_sequence, own_state, entities, blocks
+
+
+class Server:
+
+    def __init__(self, port=0, max_players=64, history=64, latency=0.0, jitter=0.0, loss=0.0, seed=0):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", port))
+        self.sock.setblocking(False)
+        self.address = self.sock.getsockname()
+        self.link = LossyLink(self.sock, latency, jitter, loss, seed)
+        self.max_players = max_players
+        self.history = history
+        main.build_level(main.world)
+        self.engine = main.Engine(headless=True)
+        # address -> [player, entity id, latest input sequence, latest acked snapshot tick, bytes sent]
+        self.clients = dict()
+        self.snapshots = dict()
+        self.tick_costs = []
+
+    def join(self, address):
+        index = len(self.clients)
+        player = RemotePlayer(50 + 60*(index % 30), 50 + 100*(index // 30), 40, 40)
+        main.world.add_entity(player)
+        self.clients[address] = client = [player, index, 0, NO_BASELINE, 0]
+        return client
+
+    def receive(self):
+        for data, address in receive_all(self.sock):
+            if len(data) != INPUT.size or data[0] != INPUT_PACKET:
+                continue
+            kind, sequence, ack, bits = INPUT.unpack(data)
+            client = self.clients.get(address)
+            if client is None:
+                if len(self.clients) >= self.max_players:
+                    continue
+                client = self.join(address)
+            # inputs are held key states, the newest one wins and older ones are stale
+            if sequence > client[2]:
+                client[2] = sequence
+                client[0].set_input(bits)
+            if ack != NO_BASELINE and (client[3] == NO_BASELINE or ack > client[3]):
+                client[3] = ack
+
+    def tick(self):
+        start = time.perf_counter()
+        self.receive()
+        self.engine.step()
+        tick = self.engine.ticks
+        entities = {client[1]: (client[0].rect.x, client[0].rect.y, client[0].state.value)
+                    for client in self.clients.values()}
+        blocks = [block.rect.x for block in main.world.moving_blocks]
+        self.snapshots[tick] = (entities, blocks)
+        self.snapshots.pop(tick - self.history, None)
+        for address, client in self.clients.items():
+            baseline = self.snapshots.get(client[3])
+            data = encode_snapshot(tick, client[1], client[2], client[0].record_state(), entities, blocks,
+                                   None if baseline is None else (client[3],) + baseline)
+            client[4] += len(data)
+            self.link.send(data, address)
+        self.link.flush()
+        self.tick_costs.append(time.perf_counter() - start)
+
+    def stats(self):
+        mean, median, p99, worst = main.summarize(self.tick_costs)
+        return {
+            "players": len(self.clients),
+            "ticks": len(self.tick_costs),
+            "tick_mean_ms": mean,
+            "tick_p99_ms": p99,
+            "bytes_per_client": [client[4] for client in self.clients.values()],
+        }
+
+
+class Client:
+
+    # sends its input every tick, keeps the recent snapshots for delta decoding and interpolation;
+    # with predict the own player is simulated locally and corrected by the server's state
+
+    def __init__(self, server_address, latency=0.0, jitter=0.0, loss=0.0, seed=0, predict=False,
+                 interpolation_delay=2, history=64):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.setblocking(False)
+        self.server_address = server_address
+        self.link = LossyLink(self.sock, latency, jitter, loss, seed)
+        self.sequence = 0
+        self.latest = NO_BASELINE
+        self.snapshots = collections.OrderedDict()
+        self.history = history
+        self.interpolation_delay = interpolation_delay
+        self.own_id = None
+        self.received = 0
+        self.player = None
+        if predict:
+            # the local player runs in this process' world, which has the same level as the server
+            self.player = RemotePlayer(50, 50, 40, 40)
+            main.world.add_entity(self.player)
+        # (sequence, bits) sent but not yet applied by the server
+        self.pending = collections.deque()
+        self.prediction_errors = []
+
+    def receive(self):
+        for data, address in receive_all(self.sock):
+            self.received += len(data)
+            if not data or data[0] != SNAPSHOT_PACKET:
+                continue
+            snapshot = decode_snapshot(data, self.snapshots)
+            if snapshot is None:
+                continue
+            tick, self.own_id, last_sequence, own_state, entities, blocks = snapshot
+            if self.latest != NO_BASELINE and tick <= self.latest:
+                continue
+            self.latest = tick
+            self.snapshots[tick] = (entities, blocks)
+            while len(self.snapshots) > self.history:
+                self.snapshots.popitem(last=False)
+            if self.player is not None:
+                self.reconcile(last_sequence, own_state, blocks)
+
+    def reconcile(self, last_sequence, own_state, blocks):
+        while self.pending and self.pending[0][0] < last_sequence:
+            self.pending.popleft()
+        if self.pending and self.pending[0][0] == last_sequence:
+            sequence, bits, predicted = self.pending.popleft()
+            self.prediction_errors.append(abs(predicted[0] - own_state[0]) + abs(predicted[1] - own_state[1]))
+        for block, x in zip(main.world.moving_blocks, blocks):
+            block.rect.x = x
+            main.world.move_block(block)
+        # back to the server's state, then the inputs it hasn't seen yet again
+        self.player.restore_state(own_state)
+        for sequence, bits, predicted in self.pending:
+            self.simulate(bits)
+
+    def simulate(self, bits):
+        self.player.set_input(bits)
+        self.player.on_keyboard(None)
+        self.player.physic()
+        main.world.move_entity(self.player)
+
+    def send_input(self, bits):
+        self.sequence += 1
+        self.link.send(INPUT.pack(INPUT_PACKET, self.sequence, self.latest, bits), self.server_address)
+        self.link.flush()
+        if self.player is not None:
+            self.simulate(bits)
+            self.pending.append((self.sequence, bits, tuple(self.player.rect.topleft)))
+
+    def interpolated(self):
+        # remote entities interpolation_delay ticks behind the newest snapshot
+        if not self.snapshots:
+            return dict()
+        render_tick = self.latest - self.interpolation_delay
+        before = after = None
+        for tick in self.snapshots:
+            if tick <= render_tick:
+                before = tick
+            elif after is None:
+                after = tick
+        if before is None:
+            return dict(self.snapshots[after][0])
+        if after is None:
+            return dict(self.snapshots[before][0])
+        alpha = (render_tick - before) / (after - before)
+        old, new = self.snapshots[before][0], self.snapshots[after][0]
+        return {entity_id: (round(old[entity_id][0] + (x - old[entity_id][0])*alpha),
+                            round(old[entity_id][1] + (y - old[entity_id][1])*alpha), state)
+                for entity_id, (x, y, state) in new.items() if entity_id in old}
+
+
+def serve(port, ticks, sim_hz, latency, jitter, loss, ready, results):
+    server = Server(port, latency=latency, jitter=jitter, loss=loss, seed=1)
+    ready.put(server.address)
+    step = 1.0 / sim_hz
+    next_time = time.perf_counter()
+    for _ in range(ticks):
+        server.tick()
+        next_time += step
+        time.sleep(max(0.0, next_time - time.perf_counter()))
+    results.put(server.stats())
+
+
+def run_loopback(players=32, ticks=600, sim_hz=60, latency=0.05, jitter=0.01, loss=0.05, seed=1):
+    # a server process and players clients in this one, the first client predicts its player
+    context = multiprocessing.get_context("spawn")
+    ready, results = context.Queue(), context.Queue()
+    server = context.Process(target=serve, args=(0, ticks, sim_hz, latency, jitter, loss, ready, results))
+    server.start()
+    address = ready.get()
+    main.build_level(main.world)
+    clients = [Client(address, latency, jitter, loss, seed + index, predict=index == 0) for index in range(players)]
+    rng = random.Random(seed)
+    bits = [0] * players
+    step = 1.0 / sim_hz
+    start = next_time = time.perf_counter()
+    while server.is_alive() and results.empty():
+        for index, client in enumerate(clients):
+            client.receive()
+            if rng.random() < 0.05:
+                bits[index] = rng.randrange(8)
+            client.send_input(bits[index])
+            client.interpolated()
+            client.link.flush()
+        next_time += step
+        time.sleep(max(0.0, next_time - time.perf_counter()))
+    seconds = time.perf_counter() - start
+    stats = results.get()
+    server.join()
+    errors = clients[0].prediction_errors
+    stats.update({
+        "seconds": seconds,
+        "latency_ms": 1000*latency,
+        "loss": loss,
+        "down_kbit_per_client": 8*sum(stats.pop("bytes_per_client"))/max(1, stats["players"])/seconds/1000,
+        "up_kbit_per_client": 8*sum(client.link.sent for client in clients)/players/seconds/1000,
+        "prediction_error_px": sum(errors)/len(errors) if errors else None,
+    })
+    return stats
+
+
+def main_net():
+    parser = argparse.ArgumentParser(description="Multiplayer over loopback with simulated latency and loss")
+    parser.add_argument("--players", type=int, default=32)
+    parser.add_argument("--ticks", type=int, default=600)
+    parser.add_argument("--sim-hz", type=int, default=60)
+    parser.add_argument("--latency", type=float, default=0.05, help="one way delay in seconds")
+    parser.add_argument("--jitter", type=float, default=0.01, help="extra random delay in seconds")
+    parser.add_argument("--loss", type=float, default=0.05, help="fraction of packets dropped")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    stats = run_loopback(args.players, args.ticks, args.sim_hz, args.latency, args.jitter, args.loss, args.seed)
+    print(json.dumps(stats, indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_net())
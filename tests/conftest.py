@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the tests run headless, the dummy driver keeps pygame from looking for a display
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
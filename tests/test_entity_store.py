@@ -0,0 +1,37 @@
+import main
+
+
+def test_rect_and_force_write_through():
+    store = main.EntityStore()
+    entity = main.StoredEntity(store, 10, 20, 30, 40)
+    store.y[entity.row] = 20.5
+    entity.rect.x += 5
+    assert (store.x[entity.row], store.y[entity.row]) == (15, 20.5)
+    entity.rect.move_ip(1, 2)
+    assert (store.x[entity.row], store.y[entity.row]) == (16, 22)
+    # copies aren't tied to the store
+    entity.rect.move(100, 100).x = 0
+    assert store.x[entity.row] == 16
+    entity.force.y = 3
+    assert store.force_y[entity.row] == 3
+    force = entity.force
+    force += (1, 1)
+    assert (store.force_x[entity.row], store.force_y[entity.row]) == (1, 4)
+    entity.force[0] = 0
+    assert store.force_x[entity.row] == 0
+
+
+def test_entity_starting_inside_a_block():
+    main.reset()
+    try:
+        main.world.add_block(main.SolidBlock(100, 0, 800, 60))
+        main.world.add_block(main.SolidBlock(40, 45, 60, 20))
+        store = main.EntityStore()
+        entity = main.StoredEntity(store, 150, 20, 20, 20)
+        entity.force = (3, 10)
+        store.step(main.world)
+        # pushed out to the left of the block it was in, it lands on the one there
+        assert tuple(entity.rect) == (80, 25, 20, 20)
+        assert entity.state == main.EntityState.walking_right
+    finally:
+        main.reset()
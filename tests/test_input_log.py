@@ -0,0 +1,62 @@
+import main
+
+
+class Events:
+
+    # collects what a replay feeds in, per tick
+
+    def __init__(self):
+        self.tick = 0
+        self.log = []
+
+    def add_key(self, state, key):
+        self.log.append((self.tick, "key", state, key))
+
+    def click(self, mouse_x, mouse_y):
+        self.log.append((self.tick, "click", mouse_x, mouse_y))
+
+
+def test_varint_round_trip():
+    out = bytearray()
+    values = [0, 1, 127, 128, 300, 2**32 - 1, 2**40]
+    for value in values:
+        main.InputLog.write_varint(out, value)
+    offset = 0
+    for value in values:
+        read, offset = main.InputLog.read_varint(out, offset)
+        assert read == value
+    assert offset == len(out)
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / "input.bin")
+    recorded = {0: [("key", True, 1073741904)], 3: [("click", 640, 360), ("key", False, 1073741904)],
+                4: [("key", True, 32)], 200: [("key", False, 32)]}
+    recorder = main.InputRecorder(path, 12345, main.InputLog.level_tiles, "levels/caves.txt")
+    for tick in range(210):
+        for change in recorded.get(tick, ()):
+            if change[0] == "key":
+                recorder.key(*change[1:])
+            else:
+                recorder.click(*change[1:])
+        recorder.end_tick()
+    recorder.close()
+
+    replay = main.InputReplay(path)
+    assert (replay.seed, replay.level_kind, replay.level) == (12345, main.InputLog.level_tiles, "levels/caves.txt")
+    events = Events()
+    while not replay.finished:
+        replay.apply(events)
+        events.tick += 1
+    assert events.log == [(tick,) + change for tick, changes in sorted(recorded.items()) for change in changes]
+    # the replay runs as long as the session did
+    assert events.tick == 210
+
+
+def test_built_in_level(tmp_path):
+    path = str(tmp_path / "input.bin")
+    recorder = main.InputRecorder(path, 7)
+    recorder.end_tick()
+    recorder.close()
+    replay = main.InputReplay(path)
+    assert (replay.seed, replay.level_kind, replay.level) == (7, main.InputLog.level_built_in, None)
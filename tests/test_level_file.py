@@ -0,0 +1,84 @@
+from pygame import Rect
+import pytest
+
+import main
+
+
+def block_records(blocks):
+    return sorted((type(block).__name__, block.layer, tuple(block.rect), getattr(block, "distance", 0),
+                   getattr(block, "speed", 0)) for block in blocks)
+
+
+def test_round_trip(tmp_path):
+    blocks = [main.SolidBlock(0, 0, 2000, 20), main.SolidBlock(1500, 900, 300, 40),
+              main.SolidBlock(3000, 2100, 50, 50), main.MovingBlock(1000, 600, 200, 40, 600, 2)]
+    blocks[1].layer = 3
+    path = str(tmp_path / "level.bin")
+    main.LevelFile.save(path, blocks, 4000, 3000, chunk_size=1024)
+    level = main.LevelFile(path)
+    try:
+        assert (level.level_width, level.level_height, level.chunk_size) == (4000, 3000, 1024)
+        assert sorted(level.chunks) == [(0, 0), (1, 0), (2, 2)]
+        loaded = [block for key in level.chunks for block in level.blocks(key)]
+        # the floor is cut at the chunk border
+        expected = [main.SolidBlock(0, 0, 1024, 20), main.SolidBlock(1024, 0, 976, 20)] + blocks[1:]
+        assert block_records(loaded) == block_records(expected)
+        # the moving block travels into the next chunk, so its chunk reaches out that far
+        assert level.chunks[(0, 0)][2].right >= 1000 + 200 + 602
+        assert set(level.chunks_in(Rect(3000, 2100, 10, 10))) == {(2, 2)}
+    finally:
+        level.close()
+
+
+def test_long_block_loads_only_the_chunks_in_view(tmp_path):
+    blocks = [main.SolidBlock(x*1024 + 100, 500, 50, 50) for x in range(100)]
+    blocks.append(main.SolidBlock(0, 1030, 100*1024, 20))
+    blocks.append(main.MovingBlock(50*1024 + 900, 200, 100, 20, 300, 2))
+    path = str(tmp_path / "floor.bin")
+    main.LevelFile.save(path, blocks, 100*1024, 2048)
+    level = main.LevelFile(path)
+    try:
+        assert set(level.chunks_in(Rect(20*1024 + 10, 400, 800, 700))) == {(20, 0), (20, 1)}
+        # only the moving block's chunk reaches out of its cell
+        assert [key for key, bounds in level.overhanging] == [(50, 0)]
+        assert set(level.chunks_in(Rect(51*1024 + 10, 150, 100, 100))) == {(50, 0)}
+    finally:
+        level.close()
+
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / "other.bin"
+    path.write_bytes(b"\0"*64)
+    with pytest.raises(ValueError):
+        main.LevelFile(str(path))
+
+
+def run_right(path, ticks, preload):
+    # holds right on the level at path, returns where the player ended
+    main.reset()
+    if preload:
+        level = main.LevelFile(path)
+        main.camera.set_level_area(level.level_width, level.level_height)
+        for key in level.chunks:
+            for block in level.blocks(key):
+                main.world.add_block(block)
+        level.close()
+    else:
+        main.world.stream(path)
+    engine = main.Engine(headless=True)
+    main.EventManager.add_key(True, engine.player.key_config.key_right)
+    engine.step(ticks)
+    position = engine.player.rect.topleft
+    main.reset()
+    return position
+
+
+def test_streamed_matches_preloaded(tmp_path):
+    # rows of small blocks keep the loader busy, the player must never fall through a row
+    blocks = [main.SolidBlock(x, y, 10, 20) for x in range(0, 20000, 10) for y in (100, 520, 980)]
+    path = str(tmp_path / "long.bin")
+    main.LevelFile.save(path, blocks, 20000, 1000)
+    expected = run_right(path, 3000, True)
+    assert expected[0] > 10000
+    for _ in range(2):
+        assert run_right(path, 3000, False) == expected
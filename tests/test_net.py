@@ -0,0 +1,35 @@
+import pytest
+
+import net
+
+
+OWN_STATE = (12.5, -3.0, 1.0)
+
+
+def test_full_snapshot():
+    entities = {1: (100, 200, 0), 7: (-40, 5, 3)}
+    data = net.encode_snapshot(10, 1, 4, OWN_STATE, entities, [600, 1200], None)
+    assert net.decode_snapshot(data, dict()) == (10, 1, 4, OWN_STATE, entities, [600, 1200])
+
+
+def test_delta_against_baseline():
+    base_entities = {1: (100, 200, 0), 2: (300, 300, 1), 3: (50, 60, 2)}
+    base_blocks = [600, 1200]
+    # 1 moves, 2 is unchanged, 3 is gone, 4 is new
+    entities = {1: (103, 190, 4), 2: (300, 300, 1), 4: (10, 20, 0)}
+    blocks = [602, 1198]
+    data = net.encode_snapshot(12, 1, 9, OWN_STATE, entities, blocks, (10, base_entities, base_blocks))
+    assert len(data) < len(net.encode_snapshot(12, 1, 9, OWN_STATE, entities, blocks, None))
+    assert net.decode_snapshot(data, {10: (base_entities, base_blocks)}) == (12, 1, 9, OWN_STATE, entities, blocks)
+
+
+def test_missing_baseline():
+    data = net.encode_snapshot(12, 1, 9, OWN_STATE, {1: (0, 0, 0)}, [600], (10, {1: (5, 5, 0)}, [600]))
+    assert net.decode_snapshot(data, {11: ({1: (5, 5, 0)}, [600])}) is None
+
+
+@pytest.mark.parametrize("value", [0, 1, -1, 63, -64, 64, 100000, -100000])
+def test_signed_round_trip(value):
+    out = bytearray()
+    net.write_signed(out, value)
+    assert net.read_signed(out, 0) == (value, len(out))
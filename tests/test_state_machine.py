@@ -0,0 +1,145 @@
+import itertools
+
+import pytest
+
+import main
+
+
+EntityState = main.EntityState
+
+
+def reference_keyboard(player, keyboard_dict):
+    # the if/elif chain Player used before the compiled state machine
+    up = keyboard_dict.get(player.key_config.key_up)
+    left = keyboard_dict.get(player.key_config.key_left)
+    right = keyboard_dict.get(player.key_config.key_right)
+    state = player.state
+    if state == EntityState.falling_down:
+        if player.on_ground:
+            player.actual_jump_force = 0
+            player.state = EntityState.standing
+        elif left is True:
+            player.state = EntityState.falling_left
+        elif right is True:
+            player.state = EntityState.falling_right
+    elif state == EntityState.falling_left:
+        if player.on_ground:
+            player.actual_jump_force = 0
+            player.state = EntityState.standing
+        elif left is False:
+            player.state = EntityState.falling_down
+        elif right is True:
+            player.state = EntityState.falling_right
+    elif state == EntityState.falling_right:
+        if player.on_ground:
+            player.actual_jump_force = 0
+            player.state = EntityState.standing
+        elif right is False:
+            player.state = EntityState.falling_down
+        elif left is True:
+            player.state = EntityState.falling_left
+    elif state == EntityState.jumping_up:
+        if player.actual_jump_force <= 0:
+            player.actual_jump_force = 0
+            player.state = EntityState.falling_down
+        elif left is True:
+            player.state = EntityState.jumping_left
+        elif right is True:
+            player.state = EntityState.jumping_right
+    elif state == EntityState.jumping_left:
+        if player.actual_jump_force <= 0:
+            player.actual_jump_force = 0
+            player.state = EntityState.falling_left
+        elif left is False:
+            player.state = EntityState.jumping_up
+        elif right is True:
+            player.state = EntityState.jumping_right
+    elif state == EntityState.jumping_right:
+        if player.actual_jump_force <= 0:
+            player.actual_jump_force = 0
+            player.state = EntityState.falling_right
+        elif right is False:
+            player.state = EntityState.jumping_up
+        elif left is True:
+            player.state = EntityState.jumping_left
+    elif state == EntityState.walking_left:
+        if not player.on_ground:
+            player.state = EntityState.falling_left
+        elif left is False:
+            player.state = EntityState.standing
+        elif right is True:
+            player.state = EntityState.walking_right
+    elif state == EntityState.walking_right:
+        if not player.on_ground:
+            player.state = EntityState.falling_right
+        elif right is False:
+            player.state = EntityState.standing
+        elif left is True:
+            player.state = EntityState.walking_left
+    else:
+        if not player.on_ground:
+            player.state = EntityState.falling_down
+        elif up is True:
+            player.actual_jump_force = player.jump_force
+            player.state = EntityState.jumping_up
+            player.on_ground = False
+        elif left is True:
+            player.state = EntityState.walking_left
+            player.on_ground = False
+        elif right is True:
+            player.state = EntityState.walking_right
+            player.on_ground = False
+
+
+def reference_force(player):
+    # the if/elif chain of Player.set_force before the compiled state machine
+    state = player.state
+    if state in (EntityState.falling_down, EntityState.falling_left, EntityState.falling_right):
+        player.force.x = {EntityState.falling_down: 0, EntityState.falling_left: -5}.get(state, 5)
+        player.force.y += player.gravity_force
+    elif state in (EntityState.jumping_up, EntityState.jumping_left, EntityState.jumping_right):
+        player.force.x = {EntityState.jumping_up: 0, EntityState.jumping_left: -5}.get(state, 5)
+        player.force.y -= player.actual_jump_force
+        player.actual_jump_force -= player.gravity_force
+    elif state in (EntityState.walking_left, EntityState.walking_right):
+        player.force.y = 0
+        player.force.x = -5 if state == EntityState.walking_left else 5
+    else:
+        player.force.x = 0
+        player.force.y = 0
+
+
+def snapshot(player):
+    return player.state, player.on_ground, player.actual_jump_force, tuple(player.force)
+
+
+@pytest.fixture(scope="module")
+def players():
+    return main.Player(0, 0, 40, 40), main.Player(0, 0, 40, 40)
+
+
+def cases():
+    keys = (None, True, False)
+    return itertools.product(EntityState, (False, True), (-0.5, 0, 3.5), keys, keys, keys)
+
+
+def test_covers_every_case():
+    assert len(list(cases())) == 1458
+
+
+def test_table_matches_reference(players):
+    compiled, reference = players
+    config = compiled.key_config
+    for state, on_ground, jump_force, up, left, right in cases():
+        keyboard_dict = {key: value for key, value in ((config.key_up, up), (config.key_left, left),
+                                                       (config.key_right, right)) if value is not None}
+        for player in players:
+            player.state, player.on_ground, player.actual_jump_force = state, on_ground, jump_force
+            player.force.update(1, 2)
+        main.Player.machine.step(compiled, compiled.input_mask(keyboard_dict))
+        reference_keyboard(reference, keyboard_dict)
+        case = (state, on_ground, jump_force, up, left, right)
+        assert snapshot(compiled) == snapshot(reference), case
+        main.Player.machine.apply_force(compiled)
+        reference_force(reference)
+        assert snapshot(compiled) == snapshot(reference), case
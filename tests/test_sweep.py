@@ -0,0 +1,49 @@
+import pytest
+from pygame import Rect
+
+import main
+
+
+@pytest.fixture
+def world():
+    main.reset()
+    yield main.world
+    main.reset()
+
+
+@pytest.mark.parametrize("dx, dy, block", [
+    (400, 0, (300, 0, 20, 200)),
+    (-400, 0, (-300, 0, 20, 200)),
+    (0, 400, (0, 300, 200, 20)),
+    (0, -400, (0, -300, 200, 20)),
+])
+def test_sweep_stops_in_the_first_block(world, dx, dy, block):
+    world.add_block(main.SolidBlock(*block))
+    # a second block further along the path must not be reached
+    world.add_block(main.SolidBlock(*Rect(block).move(dx // 4, dy // 4)))
+    rect = Rect(50, 50, 40, 40)
+    moved = rect.move(*world.sweep(rect, dx, dy))
+    assert moved.colliderect(Rect(block))
+    assert not moved.colliderect(Rect(block).move(dx // 4, dy // 4))
+
+
+def test_fast_player_lands_on_a_thin_block(world):
+    # without the sweep the move would end below the block
+    world.add_block(main.SolidBlock(0, 300, 400, 20))
+    player = main.Player(50, 100, 40, 40)
+    world.add_entity(player)
+    player.force.y = 400
+    player.physic()
+    assert player.rect.bottom == 300
+    assert player.on_ground and player.state == main.EntityState.standing
+
+
+def test_fast_player_hits_a_thin_ceiling(world):
+    world.add_block(main.SolidBlock(0, 250, 400, 20))
+    player = main.Player(50, 500, 40, 40)
+    world.add_entity(player)
+    player.state = main.EntityState.jumping_up
+    player.force.y = -400
+    player.physic()
+    assert player.rect.top == 270
+    assert player.force.y == 0